@@ -8,9 +8,14 @@ https://docs.djangoproject.com/en/3.0/howto/deployment/wsgi/
 """
 
 import os
+import threading
 
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ecommerce.settings')
 
 application = get_wsgi_application()
+
+# Build the search suggestions index as the server starts rather than on the first keystroke
+from store.autocomplete import autocomplete
+threading.Thread(target=autocomplete.build, daemon=True).start()
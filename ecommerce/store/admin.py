@@ -11,4 +11,7 @@ admin.site.register(ProductViewCount)
 admin.site.register(ProductReview)
 admin.site.register(ReviewReact)
 admin.site.register(Bidder)
-admin.site.register(Wishlist)
\ No newline at end of file
+admin.site.register(Wishlist)
+admin.site.register(CustomerProfile)
+admin.site.register(ProductNeighbor)
+admin.site.register(OutgoingEmail)
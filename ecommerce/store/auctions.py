@@ -0,0 +1,209 @@
+import heapq
+import threading
+import traceback
+
+from django.conf import settings
+from django.core.mail import EmailMessage
+from django.db import close_old_connections, transaction
+from django.db.models import F, Q
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from .autocomplete import autocomplete
+from .cart import invalidate_cart_summary
+from .live import bid_updates, get_bid_state
+from .models import Order, OrderItem, OutgoingEmail, Product
+from .recommender import get_generation, new_generation, recommendation_cache, refresh_neighbors
+from .search import invalidate_search_results
+
+# Shared counter telling the scheduler that an auction was listed, unlisted or had its end date changed
+schedule_generation_key = 'auctions:schedule_generation'
+# Maximum number of seconds between two checks of the shared counter by the scheduler
+schedule_check_interval = 0.5
+
+def reschedule_auctions():
+    '''
+    Tell the scheduler, in whichever process runs it, to reload the auction end dates once
+    the current transaction commits - must be called after an auction is listed, unlisted or
+    has its end date changed
+    '''
+
+    new_generation(schedule_generation_key)
+
+def get_due_auctions():
+    return Product.objects.filter(selling_type='auction', is_active=True, end_date__lte=timezone.now())
+
+def settle_auctions(product_ids=None):
+    '''
+    Close every auction that has reached its end date (only those in 'product_ids' if given),
+    in one transaction with a fixed number of queries
+    - Each auction with a highest bidder is added to the bidder's cart, creating their open
+      order if needed, and both the bidder and seller are emailed
+    - Auctions without any bids are simply unlisted, and their seller is told no one bid
+    - The auctions are claimed by unlisting them with one conditional update. If another
+      process claimed any of them first, nothing is changed and they are left to it, so an
+      auction is only ever settled once
+
+    Returns the list of settled auctions
+    '''
+
+    with transaction.atomic():
+        due = get_due_auctions()
+        if product_ids is not None:
+            due = due.filter(id__in=product_ids)
+        products = list(due.select_for_update().select_related('highest_bidder', 'seller'))
+        if not products:
+            return []
+
+        if Product.objects.filter(id__in=[product.id for product in products], is_active=True) \
+                          .update(is_active=False) != len(products):
+            transaction.set_rollback(True)
+            return []
+
+        sold = [product for product in products if product.highest_bidder is not None]
+        bidder_ids = {product.highest_bidder_id for product in sold}
+
+        # Find or create the open order of every winner
+        orders = {order.customer_id: order for order in Order.objects.filter(customer_id__in=bidder_ids, complete=False)}
+        missing_orders = bidder_ids - orders.keys()
+        if missing_orders:
+            Order.objects.bulk_create([Order(customer_id=bidder_id, complete=False) for bidder_id in missing_orders])
+            orders.update({order.customer_id: order
+                           for order in Order.objects.filter(customer_id__in=missing_orders, complete=False)})
+
+        # Add one unit of each auction to its winner's order
+        winning_items = Q(id__in=[])
+        for product in sold:
+            winning_items |= Q(order=orders[product.highest_bidder_id], product=product)
+        existing_items = set(OrderItem.objects.filter(winning_items).values_list('product_id', flat=True))
+        if existing_items:
+            OrderItem.objects.filter(winning_items, product_id__in=existing_items).update(quantity=F('quantity') + 1)
+        OrderItem.objects.bulk_create([OrderItem(order=orders[product.highest_bidder_id], product=product, quantity=1)
+                                       for product in sold if product.id not in existing_items])
+
+        emails = []
+        for product in products:
+            bidder, seller = product.highest_bidder, product.seller
+            if bidder is not None:
+                buyer_template = render_to_string('store/email_auctionEnd_to_buyer.html', {'name': bidder.nickname, 'product': product.name, 'price': product.starting_bid})
+                emails.append(EmailMessage('You have win the Auction!', buyer_template, settings.EMAIL_HOST_USER, [bidder.email]))
+            if seller is not None:
+                if bidder is not None:
+                    seller_template = render_to_string('store/email_auctionEnd_to_seller.html', {'name': seller.nickname, 'product': product.name, 'bidder': bidder.nickname, 'price': product.starting_bid})
+                else:
+                    seller_template = render_to_string('store/email_auctionEnd_no_bids_to_seller.html', {'name': seller.nickname, 'product': product.name})
+                emails.append(EmailMessage('Your auction has ended!', seller_template, settings.EMAIL_HOST_USER, [seller.email]))
+        OutgoingEmail.enqueue(emails)
+
+    # The products were unlisted with an update, so do what the signals for unlisting a product would
+    recommendation_cache.invalidate_all()
+    recommendation_cache.invalidate_guest()
+    autocomplete.update_products([product.id for product in products])
+    invalidate_search_results([product.id for product in products])
+    for product in products:
+        product.is_active = False
+        refresh_neighbors(product.id)
+        invalidate_cart_summary(product.highest_bidder)
+        if bid_updates.is_watched(product.id):
+            bid_updates.publish(product.id, get_bid_state(product.id))
+    return products
+
+class AuctionScheduler:
+    '''
+    Closes auctions at their end dates
+    - Keeps a min-heap of (end date, product id) for the active auctions, loaded with one
+      query when started
+    - Auctions are listed and edited by other processes, which call reschedule_auctions to bump
+      a shared counter. The scheduler thread reads the counter every schedule_check_interval
+      seconds and only reloads the heap when it moved
+    - The scheduler thread sleeps until the earliest end date, then closes the auctions that
+      are due. Entries made stale by an edit or unlisting are harmless, as settle_auctions only
+      closes auctions that are actually due
+    - Only one process should run the scheduler, see the run_auctions command
+    '''
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.heap = []
+        # Value of the shared counter when the heap was loaded
+        self.generation = None
+        self.thread = None
+        self.stopping = False
+
+    def start(self):
+        with self.condition:
+            if self.thread is None:
+                self.stopping = False
+                self.thread = threading.Thread(target=self.run, name='auction-scheduler', daemon=True)
+                self.thread.start()
+
+    def stop(self):
+        '''
+        Stop the scheduler thread, waiting for it to finish closing any auctions that were due
+        '''
+
+        with self.condition:
+            thread = self.thread
+            self.stopping = True
+            self.condition.notify()
+        if thread is not None:
+            thread.join()
+        with self.condition:
+            self.thread = None
+            self.heap = []
+
+    def load(self):
+        # Read the generation first, so that a change made during the load causes another one
+        generation = get_generation(schedule_generation_key)
+        deadlines = list(Product.objects.filter(selling_type='auction', is_active=True, end_date__isnull=False)
+                                        .values_list('end_date', 'id'))
+        with self.condition:
+            self.heap = deadlines
+            heapq.heapify(self.heap)
+            self.generation = generation
+            self.condition.notify()
+
+    def refresh(self):
+        '''
+        Reload the heap if auctions were listed, unlisted or edited since it was loaded
+        '''
+
+        if get_generation(schedule_generation_key) != self.generation:
+            self.load()
+
+    def get_due(self, timeout):
+        '''
+        Wait until at least one auction has reached its end date or 'timeout' seconds have passed,
+        and return the ids of all auctions that have (possibly none), or None once the scheduler is stopping
+        '''
+
+        with self.condition:
+            if self.stopping:
+                return None
+            now = timezone.now()
+            if not self.heap or self.heap[0][0] > now:
+                self.condition.wait(min((self.heap[0][0] - now).total_seconds(), timeout) if self.heap else timeout)
+                if self.stopping:
+                    return None
+                now = timezone.now()
+
+            due = []
+            while self.heap and self.heap[0][0] <= now:
+                due.append(heapq.heappop(self.heap)[1])
+            return due
+
+    def run(self):
+        self.load()
+        while True:
+            due = self.get_due(schedule_check_interval)
+            if due is None:
+                return
+            close_old_connections()
+            try:
+                if due:
+                    settle_auctions()
+                self.refresh()
+            except Exception:
+                traceback.print_exc()
+
+auction_scheduler = AuctionScheduler()
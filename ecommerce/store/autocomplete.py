@@ -0,0 +1,274 @@
+import bisect
+import heapq
+import re
+import threading
+import time
+
+from django.db import transaction
+
+from .models import Customer, Product, SharedCounter, get_product_tags
+from .recommender import get_generation
+
+# Maximum number of suggestions returned for a prefix
+max_suggestions = 8
+# Shared counter telling every process that listed products, their names or tags, or sellers have changed
+autocomplete_version_key = 'autocomplete:version'
+# Minimum number of seconds between two checks of the shared counter
+refresh_interval = 5
+# Number of seconds between two reloads of the sold units of every product, which is how
+# sales made by other processes reach the index
+sales_refresh_interval = 60
+
+def get_word_starts(label):
+    '''
+    Return every lowercase suffix of a label that starts at one of its words, so that a
+    prefix of any of them matches the label (eg. 'cat food' and 'food' for 'Cat Food')
+    '''
+
+    label = label.lower()
+    return [label[match.start():] for match in re.finditer(r'\w+', label)]
+
+class Autocomplete:
+    '''
+    In-process prefix index of the tag names, product names and seller nicknames of listed products
+    - Every word start of every name is kept in a sorted array, so the names matching a prefix
+      are found with a binary search
+    - Suggestions are ranked by units sold: a product's own sold units, or the total sold
+      units of the listed products carrying a tag or sold by a seller
+    - The index is built with three queries as the server starts (see wsgi.py), then kept up to
+      date by signals calling update_products, update_sales and update_seller
+    - Listing changes made by other processes (eg. other web workers or run_auctions) bump a
+      shared counter. Suggesting reads it at most every refresh_interval seconds, and rebuilds
+      the index when it changed
+    - Sales only change rankings, so they don't bump the shared counter. Other processes reload
+      every product's sold units with one query every sales_refresh_interval seconds instead
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Value of the shared counter the index is up to date with, None until it is built
+        self.version = None
+        self.checked_at = 0
+        self.sales_checked_at = 0
+        self.reset()
+
+    def reset(self):
+        # Product id -> (name, seller id, tags, sold units) of every listed product
+        self.products = dict()
+        # Tag name -> [number of listed products, sold units]
+        self.tags = dict()
+        # Seller id -> [nickname, number of listed products, sold units]
+        self.sellers = dict()
+        # Sorted (word start, kind, key) entries, kind being 'product', 'tag' or 'seller'
+        self.words = []
+
+    def add_words(self, label, kind, key):
+        entries = [(word, kind, key) for word in get_word_starts(label)]
+        if self.version is None:
+            # While building, words are only sorted once everything is loaded (see build)
+            self.words.extend(entries)
+        else:
+            for entry in entries:
+                bisect.insort(self.words, entry)
+
+    def remove_words(self, label, kind, key):
+        for word in get_word_starts(label):
+            position = bisect.bisect_left(self.words, (word, kind, key))
+            if position < len(self.words) and self.words[position] == (word, kind, key):
+                del self.words[position]
+
+    def add_product(self, product_id, name, seller_id, tags, sold_unit):
+        self.products[product_id] = (name, seller_id, tags, sold_unit)
+        self.add_words(name, 'product', product_id)
+        for tag in tags:
+            if tag not in self.tags:
+                self.tags[tag] = [0, 0]
+                self.add_words(tag, 'tag', tag)
+            self.tags[tag][0] += 1
+            self.tags[tag][1] += sold_unit
+        if seller_id in self.sellers:
+            self.sellers[seller_id][1] += 1
+            self.sellers[seller_id][2] += sold_unit
+
+    def remove_product(self, product_id):
+        if product_id not in self.products:
+            return
+        name, seller_id, tags, sold_unit = self.products.pop(product_id)
+        self.remove_words(name, 'product', product_id)
+        for tag in tags:
+            self.tags[tag][0] -= 1
+            self.tags[tag][1] -= sold_unit
+            if self.tags[tag][0] == 0:
+                del self.tags[tag]
+                self.remove_words(tag, 'tag', tag)
+        if seller_id in self.sellers:
+            self.sellers[seller_id][1] -= 1
+            self.sellers[seller_id][2] -= sold_unit
+
+    def set_sold_unit(self, product_id, sold_unit):
+        name, seller_id, tags, old_sold_unit = self.products[product_id]
+        self.products[product_id] = (name, seller_id, tags, sold_unit)
+        for tag in tags:
+            self.tags[tag][1] += sold_unit - old_sold_unit
+        if seller_id in self.sellers:
+            self.sellers[seller_id][2] += sold_unit - old_sold_unit
+
+    def load_sales(self, product_ids=None):
+        '''
+        Reload the sold units of the given products (or every product) in the index with one query
+        '''
+
+        products = Product.objects.filter(remaining_unit__gt=0, is_active=True)
+        if product_ids is not None:
+            products = products.filter(id__in=product_ids)
+        for product_id, sold_unit in products.values_list('id', 'sold_unit'):
+            if product_id in self.products:
+                self.set_sold_unit(product_id, sold_unit)
+
+    def set_seller(self, seller_id, nickname):
+        if seller_id in self.sellers:
+            self.remove_words(self.sellers[seller_id][0], 'seller', seller_id)
+            self.sellers[seller_id][0] = nickname
+        else:
+            self.sellers[seller_id] = [nickname, 0, 0]
+        self.add_words(nickname, 'seller', seller_id)
+
+    def load(self, product_ids=None):
+        '''
+        Add the listed products among the given ids (or every listed product) and their sellers
+        to the index, loading them with a query each for the products, their tags and their sellers
+        '''
+
+        products = Product.objects.filter(remaining_unit__gt=0, is_active=True)
+        if product_ids is not None:
+            products = products.filter(id__in=product_ids)
+        rows = list(products.values_list('id', 'name', 'seller_id', 'sold_unit'))
+        product_tags = get_product_tags([row[0] for row in rows] if product_ids is not None else None)
+
+        seller_ids = {seller_id for _, _, seller_id, _ in rows if seller_id is not None} - self.sellers.keys()
+        for seller_id, nickname in Customer.objects.filter(id__in=seller_ids).values_list('id', 'nickname'):
+            self.set_seller(seller_id, nickname or '')
+        for product_id, name, seller_id, sold_unit in rows:
+            self.add_product(product_id, name, seller_id, tuple(product_tags.get(product_id, ())), sold_unit)
+
+    def build(self):
+        '''
+        Build the index if it was never built, or rebuild it if another process changed listings
+        or sellers since it was built. The shared counter is read at most every refresh_interval seconds,
+        and sales are reloaded every sales_refresh_interval seconds
+        '''
+
+        with self.lock:
+            now = time.monotonic()
+            if self.version is not None and now - self.checked_at < refresh_interval:
+                return
+            self.checked_at = now
+            version = get_generation(autocomplete_version_key)
+            if version == self.version:
+                if now - self.sales_checked_at >= sales_refresh_interval:
+                    self.load_sales()
+                    self.sales_checked_at = now
+                return
+
+            self.version = None
+            self.reset()
+            self.load()
+            self.words.sort()
+            self.version = version
+            self.sales_checked_at = now
+
+    def publish_update(self):
+        '''
+        Bump the shared counter once the current transaction commits, so that other processes
+        rebuild their index. This process's index is already up to date, so it keeps it unless
+        another process also made changes in the meantime
+        '''
+
+        def bump():
+            known_version = self.version
+            SharedCounter.increment({autocomplete_version_key: 1})
+            version = get_generation(autocomplete_version_key)
+            with self.lock:
+                if known_version is not None and self.version == known_version and version == known_version + 1:
+                    self.version = version
+
+        transaction.on_commit(bump)
+
+    def update_products(self, product_ids):
+        '''
+        Reload the given products, dropping those that were deleted or are no longer listed, and
+        tell other processes to rebuild their index
+        - Only sales changed (see update_sales) don't need other processes to rebuild
+        '''
+
+        product_ids = set(product_ids)
+        if not product_ids:
+            return
+        with self.lock:
+            if self.version is not None:
+                for product_id in product_ids:
+                    self.remove_product(product_id)
+                self.load(product_ids)
+        self.publish_update()
+
+    def update_sales(self, product_ids):
+        '''
+        Reload the sold units of the given products after they sold without being sold out or
+        restocked. Other processes pick the change up within sales_refresh_interval seconds
+        '''
+
+        product_ids = set(product_ids)
+        with self.lock:
+            if self.version is not None and product_ids:
+                self.load_sales(product_ids)
+
+    def update_seller(self, seller_id, nickname):
+        '''
+        Rename a seller in the index after their nickname changes
+        '''
+
+        with self.lock:
+            if self.version is not None and seller_id in self.sellers:
+                self.set_seller(seller_id, nickname or '')
+        self.publish_update()
+
+    def get_weight(self, kind, key):
+        if kind == 'product':
+            return self.products[key][3]
+        elif kind == 'tag':
+            return self.tags[key][1]
+        return self.sellers[key][2]
+
+    def get_label(self, kind, key):
+        if kind == 'product':
+            return self.products[key][0]
+        elif kind == 'tag':
+            return key
+        return self.sellers[key][0]
+
+    def suggest(self, prefix, n=max_suggestions):
+        '''
+        Return the 'n' best selling product names, tags and sellers with a word starting
+        with the prefix, as a list of dicts of their kind and label
+        '''
+
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        self.build()
+
+        with self.lock:
+            matches = set()
+            position = bisect.bisect_left(self.words, (prefix,))
+            while position < len(self.words) and self.words[position][0].startswith(prefix):
+                _, kind, key = self.words[position]
+                # Sellers are only suggested while they have listed products
+                if kind != 'seller' or self.sellers[key][1] > 0:
+                    matches.add((kind, key))
+                position += 1
+
+            # Sort the matches first so that ties are always broken the same way
+            best = heapq.nlargest(n, sorted(matches), key=lambda match: self.get_weight(*match))
+            return [{'kind': kind, 'label': self.get_label(kind, key)} for kind, key in best]
+
+autocomplete = Autocomplete()
@@ -0,0 +1,43 @@
+from django.core.cache import cache
+
+from .models import OrderItem
+from .recommender import get_generation, new_generation
+
+# Number of seconds a customer's cart summary is cached for
+# - Summaries are invalidated whenever the cart changes, so this only bounds how long the
+#   total can lag behind a seller editing the price of a product already in the cart
+cart_summary_timeout = 60
+
+def get_cart_generation_key(customer_id):
+    return f'cart:generation:{customer_id}'
+
+def get_cart_summary_key(customer_id):
+    '''
+    Return the cache key of the customer's cart summary
+    - The key holds the generation of their cart, a shared counter, so that a change made by
+      any process (eg. another web worker or run_auctions) is seen by every other process
+    '''
+
+    return f'cart_summary:{customer_id}:{get_generation(get_cart_generation_key(customer_id))}'
+
+def get_cart_summary(customer):
+    '''
+    Return the number of items in the customer's cart and their total price as a dict
+    with keys 'items' and 'total', calculated in one query and cached per customer
+    '''
+
+    key = get_cart_summary_key(customer.id)
+    summary = cache.get(key)
+    if summary is None:
+        summary = OrderItem.summarize(OrderItem.objects.filter(order__customer=customer, order__complete=False))
+        cache.set(key, summary, cart_summary_timeout)
+    return summary
+
+def invalidate_cart_summary(customer):
+    '''
+    Drop the customer's cached cart summary in every process, once the current transaction
+    commits - must be called after their cart changes
+    '''
+
+    if customer is not None:
+        new_generation(get_cart_generation_key(customer.id))
@@ -0,0 +1,14 @@
+from .cart import get_cart_summary
+
+def cart_summary(request):
+    '''
+    Add the number of items in the user's cart ('cartItems') and their total price ('cartTotal')
+    to every template context, for the cart icon in the navigation bar
+    '''
+
+    customer = getattr(request.user, 'customer', None) if request.user.is_authenticated else None
+    if customer is None:
+        return {'cartItems': 0, 'cartTotal': 0}
+
+    summary = get_cart_summary(customer)
+    return {'cartItems': summary['items'], 'cartTotal': summary['total']}
@@ -0,0 +1,105 @@
+import asyncio
+import threading
+
+from .models import Product
+
+# Maximum number of requests per process that may wait for bid updates at once
+max_watchers = 200
+# Number of seconds a request waits for a new bid before returning the unchanged state
+watch_timeout = 25
+# Number of most recent bids included in an auction's state
+recent_bids_shown = 5
+
+def get_bid_state(product_id):
+    '''
+    Return the current bidding state of an auction as a JSON serializable dict, or None if it does not exist
+    '''
+
+    product = Product.objects.filter(id=product_id).select_related('highest_bidder') \
+                             .only('id', 'is_active', 'starting_bid', 'highest_bidder__nickname').first()
+    if product is None:
+        return None
+
+    bids = list(product.bidder.order_by('-id').values_list('name', 'price')[:recent_bids_shown])
+    return {
+        'is_active': product.is_active,
+        'starting_bid': str(product.starting_bid),
+        'highest_bidder': product.highest_bidder.nickname if product.highest_bidder else None,
+        'bidder_count': product.bidder_count,
+        'recent_bids': [{'name': name, 'price': str(price)} for name, price in bids],
+    }
+
+class BidUpdates:
+    '''
+    In-process publish/subscribe of auction bid changes
+    - Views that change an auction publish its new state, which wakes every request of this
+      process waiting on that auction. Requests in other processes see the change when their
+      wait times out and they reload the state
+    - Publishing may happen from any thread, waiting happens on an event loop
+    - At most 'max_watchers' requests may wait at once, further ones are turned away
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = dict()
+        self.n_watchers = 0
+
+    def enter(self):
+        with self.lock:
+            if self.n_watchers >= max_watchers:
+                return False
+            self.n_watchers += 1
+            return True
+
+    def leave(self):
+        with self.lock:
+            self.n_watchers -= 1
+
+    def is_watched(self, product_id):
+        with self.lock:
+            return product_id in self.waiters
+
+    def publish(self, product_id, state):
+        with self.lock:
+            waiters = self.waiters.pop(product_id, set())
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(self.notify, future, state)
+
+    @staticmethod
+    def notify(future, state):
+        if not future.done():
+            future.set_result(state)
+
+    def subscribe(self, product_id):
+        '''
+        Start listening for states published for the auction, returning a waiter to pass to wait
+        and unsubscribe
+        - Must be called from the event loop the waiter will be awaited on
+        '''
+
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+        with self.lock:
+            self.waiters.setdefault(product_id, set()).add(waiter)
+        return waiter
+
+    def unsubscribe(self, product_id, waiter):
+        with self.lock:
+            waiters = self.waiters.get(product_id)
+            if waiters is not None:
+                waiters.discard(waiter)
+                if not waiters:
+                    del self.waiters[product_id]
+
+    @staticmethod
+    async def wait(waiter, timeout):
+        '''
+        Wait for the next state published to the waiter, returning None if none is published within 'timeout' seconds
+        '''
+
+        try:
+            return await asyncio.wait_for(waiter[1], timeout)
+        except asyncio.TimeoutError:
+            return None
+
+bid_updates = BidUpdates()
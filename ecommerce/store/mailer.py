@@ -0,0 +1,93 @@
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+
+from django.core.mail import get_connection
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import OutgoingEmail
+
+# Number of times an email is tried before it is given up on
+max_attempts = 5
+# Delay before the first retry of a failed email, doubled after each further failure
+retry_delay = datetime.timedelta(seconds=30)
+# How long a claimed batch is held by a worker before other workers may retry it
+claim_timeout = datetime.timedelta(minutes=5)
+
+def get_due_emails():
+    return OutgoingEmail.objects.filter(sent__isnull=True, attempts__lt=max_attempts, next_attempt__lte=timezone.now())
+
+def claim_batch(batch_size):
+    '''
+    Claim up to 'batch_size' due emails for the calling worker, returning them as a list
+    - Emails claimed by another worker in the meantime are left out
+    '''
+
+    ids = list(get_due_emails().order_by('next_attempt', 'id').values_list('id', flat=True)[:batch_size])
+    if not ids:
+        return []
+
+    claim = uuid4().hex
+    get_due_emails().filter(id__in=ids).update(claim=claim, next_attempt=timezone.now() + claim_timeout)
+    return list(OutgoingEmail.objects.filter(claim=claim).order_by('id'))
+
+def send_batch(emails):
+    '''
+    Send a batch of claimed emails over a single mail server connection
+
+    Returns the number of emails sent
+    '''
+
+    n_sent = 0
+    try:
+        connection = get_connection()
+        connection.open()
+    except Exception as error:
+        for email in emails:
+            record_failure(email, error)
+        return n_sent
+
+    try:
+        for email in emails:
+            try:
+                connection.send_messages([email.to_message(connection)])
+            except Exception as error:
+                record_failure(email, error)
+            else:
+                OutgoingEmail.objects.filter(id=email.id).update(sent=timezone.now(), claim='', last_error='')
+                n_sent += 1
+    finally:
+        connection.close()
+    return n_sent
+
+def record_failure(email, error):
+    email.attempts += 1
+    OutgoingEmail.objects.filter(id=email.id).update(
+        attempts=email.attempts,
+        next_attempt=timezone.now() + retry_delay * 2 ** (email.attempts - 1),
+        claim='',
+        last_error=repr(error))
+
+def deliver_emails(workers=4, batch_size=20):
+    '''
+    Send every email that is currently due, using a pool of 'workers' threads that each
+    claim and send batches of up to 'batch_size' emails until none are left
+
+    Returns the number of emails sent
+    '''
+
+    def work():
+        n_sent = 0
+        try:
+            while True:
+                emails = claim_batch(batch_size)
+                if not emails:
+                    return n_sent
+                n_sent += send_batch(emails)
+        finally:
+            close_old_connections()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = [pool.submit(work) for _ in range(workers)]
+    return sum(result.result() for result in results)
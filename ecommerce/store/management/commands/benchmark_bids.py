@@ -0,0 +1,68 @@
+import datetime
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+from django.utils import timezone
+
+from store.models import Bidder, Customer, Product
+
+class Command(BaseCommand):
+    '''
+    Fire many concurrent bids at a temporary auction, then check that the auction ended up
+    with the highest bid and a consistent bid history, and report the throughput
+    - The temporary auction and its bids are deleted afterwards
+    '''
+
+    help = 'Benchmark concurrent bidding on a single auction'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bids', type=int, default=2000, help='Number of bids to place')
+        parser.add_argument('--threads', type=int, default=16, help='Number of threads placing bids')
+
+    def handle(self, *args, **options):
+        customers = list(Customer.objects.all()[:20])
+        if len(customers) < 2:
+            raise CommandError('At least two customers are needed to run the benchmark')
+        seller, bidders = customers[0], customers[1:]
+
+        product = Product.objects.create(name='Bid benchmark', selling_type='auction', price=1, starting_bid=1,
+                                         remaining_unit=1, description='Temporary auction used by benchmark_bids',
+                                         delivery_period=datetime.timedelta(days=1), seller=seller, is_active=True,
+                                         end_date=timezone.now() + datetime.timedelta(days=1))
+        bids = [(random.choice(bidders), random.randint(2, options['bids'] * 10)) for _ in range(options['bids'])]
+
+        def place(bid):
+            try:
+                return Product.place_bid(product.id, *bid)
+            finally:
+                close_old_connections()
+
+        try:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['threads']) as pool:
+                results = list(pool.map(place, bids))
+            elapsed = time.perf_counter() - start
+
+            product.refresh_from_db()
+            history = list(Bidder.objects.filter(product=product).order_by('id').values_list('name', 'price'))
+            highest_bidder, highest_bid = max(bids, key=lambda bid: bid[1])
+            errors = []
+            if product.starting_bid != highest_bid:
+                errors.append(f'final bid is {product.starting_bid}, expected {highest_bid}')
+            if len(history) != sum(results):
+                errors.append(f'{len(history)} bids were recorded but {sum(results)} were accepted')
+            if any(earlier[1] >= later[1] for earlier, later in zip(history, history[1:])):
+                errors.append('the bid history is not strictly increasing')
+            if history and (history[-1][0] != product.highest_bidder.nickname or history[-1][1] != product.starting_bid):
+                errors.append('the last recorded bid does not match the highest bidder')
+        finally:
+            product.delete()
+
+        self.stdout.write(f'Placed {len(bids)} bids with {options["threads"]} threads in {elapsed:.2f}s '
+                          f'({len(bids) / elapsed:.0f} bids/s), {sum(results)} accepted')
+        if errors:
+            raise CommandError('; '.join(errors))
+        self.stdout.write(self.style.SUCCESS('Final auction state is consistent'))
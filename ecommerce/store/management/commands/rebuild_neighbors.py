@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.recommender import rebuild_neighbors
+
+class Command(BaseCommand):
+    '''
+    Recalculate the similar items stored for every product
+    '''
+
+    help = 'Recalculate the similar items stored for every product'
+
+    def handle(self, *args, **options):
+        n_products = rebuild_neighbors()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt the similar items of {n_products} products'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from store.models import CustomerProfile
+from store.recommender import recommendation_cache
+
+class Command(BaseCommand):
+    '''
+    Rebuild customers' recommender profiles from their viewing and purchase history.
+    Used to backfill profiles, or to repair them after product tags have been edited
+    '''
+
+    help = "Rebuild customers' recommender profiles from their viewing and purchase history"
+
+    def add_arguments(self, parser):
+        parser.add_argument('customer_ids', nargs='*', type=int, help='Only rebuild these customers (default: all)')
+
+    def handle(self, *args, **options):
+        n_profiles = CustomerProfile.rebuild(options['customer_ids'] or None)
+        recommendation_cache.invalidate_all()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {n_profiles} customer profiles'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.search import rebuild_search_index
+
+class Command(BaseCommand):
+    '''
+    Rebuild the full text search index from every product
+    '''
+
+    help = 'Rebuild the full text search index from every product'
+
+    def handle(self, *args, **options):
+        n_products = rebuild_search_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {n_products} products'))
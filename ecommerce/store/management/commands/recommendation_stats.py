@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from store.recommender import recommendation_cache
+
+class Command(BaseCommand):
+    '''
+    Show the hits and misses of the recommendation cache counted by every process
+    '''
+
+    help = 'Show the hit rate of the recommendation cache'
+
+    def handle(self, *args, **options):
+        stats = recommendation_cache.stats()
+        self.stdout.write(f"Hits: {stats['hits']}, misses: {stats['misses']}, hit rate: {stats['hit_rate']:.1%}")
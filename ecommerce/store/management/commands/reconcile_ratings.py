@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from store.models import Product
+from store.recommender import recommendation_cache
+
+class Command(BaseCommand):
+    '''
+    Recalculate every product's stored review totals from its reviews, repairing any drift
+    (eg. after reviews were edited through the admin site)
+    '''
+
+    help = "Recalculate every product's stored review totals from its reviews"
+
+    def handle(self, *args, **options):
+        n_repaired = Product.reconcile_ratings()
+        if n_repaired:
+            recommendation_cache.invalidate_all()
+            recommendation_cache.invalidate_guest()
+        self.stdout.write(self.style.SUCCESS(f'Repaired the review totals of {n_repaired} products'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from store.models import ProductReview
+
+class Command(BaseCommand):
+    '''
+    Recalculate every review's stored like and dislike counts from its reacts, repairing any drift
+    (eg. after reacts were changed through the admin site)
+    '''
+
+    help = "Recalculate every review's stored like and dislike counts from its reacts"
+
+    def handle(self, *args, **options):
+        n_repaired = ProductReview.reconcile_reacts()
+        self.stdout.write(self.style.SUCCESS(f'Repaired the react counts of {n_repaired} reviews'))
@@ -0,0 +1,51 @@
+import datetime
+import os
+import socket
+import time
+from uuid import uuid4
+
+from django.core.management.base import BaseCommand
+
+from store.auctions import auction_scheduler
+from store.models import ServiceLease
+
+# Name of the lease held by the process closing auctions
+lease_name = 'auctions'
+# Number of renewal intervals the lease lasts for without being renewed
+lease_intervals = 3
+
+class Command(BaseCommand):
+    '''
+    Close auctions as they reach their end dates (see auctions.py)
+    - Any number of copies may be started. They share a lease in the database so that only
+      one of them closes auctions at a time, and another takes over if that one stops
+    - Auctions listed or edited by the web server are picked up as soon as the scheduler sees
+      the shared counter they bump move (see reschedule_auctions)
+    '''
+
+    help = 'Close auctions as they reach their end dates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between renewing the lease')
+
+    def handle(self, *args, **options):
+        holder = f'{socket.gethostname()}:{os.getpid()}:{uuid4().hex}'
+        lease_duration = datetime.timedelta(seconds=options['interval'] * lease_intervals)
+        leader = False
+        try:
+            while True:
+                if ServiceLease.acquire(lease_name, holder, lease_duration):
+                    if not leader:
+                        self.stdout.write(self.style.SUCCESS('Acquired the auction lease, closing auctions'))
+                        leader = True
+                        auction_scheduler.start()
+                elif leader:
+                    self.stdout.write(self.style.WARNING('Lost the auction lease, waiting to take it back'))
+                    leader = False
+                    auction_scheduler.stop()
+                time.sleep(options['interval'])
+        finally:
+            auction_scheduler.stop()
+            if leader:
+                ServiceLease.release(lease_name, holder)
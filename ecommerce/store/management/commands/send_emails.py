@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from store.mailer import deliver_emails
+
+class Command(BaseCommand):
+    '''
+    Deliver the emails waiting in the outbox, either once or continuously
+    (see mailer.py for how batches are claimed and retried)
+    '''
+
+    help = 'Deliver the emails waiting in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Send the emails that are due and exit')
+        parser.add_argument('--interval', type=float, default=5, help='Seconds to wait between checks of the outbox')
+        parser.add_argument('--workers', type=int, default=4, help='Number of threads sending emails')
+        parser.add_argument('--batch-size', type=int, default=20, help='Number of emails sent over each connection')
+
+    def handle(self, *args, **options):
+        while True:
+            n_sent = deliver_emails(options['workers'], options['batch_size'])
+            if n_sent or options['once']:
+                self.stdout.write(self.style.SUCCESS(f'Sent {n_sent} emails'))
+            if options['once']:
+                return
+            time.sleep(options['interval'])
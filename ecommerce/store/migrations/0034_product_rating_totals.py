@@ -0,0 +1,33 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:01
+
+from django.db import migrations, models
+
+
+def populate_rating_totals(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    products = Product.objects.annotate(actual_sum=models.Sum('reviews__rating'), actual_count=models.Count('reviews'))
+    for product in products:
+        product.rating_sum = product.actual_sum or 0
+        product.review_count = product.actual_count
+    Product.objects.bulk_update(products, ['rating_sum', 'review_count'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0033_customerprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='review_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_rating_totals, migrations.RunPython.noop),
+    ]
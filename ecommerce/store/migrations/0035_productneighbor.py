@@ -0,0 +1,60 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+import heapq
+
+# Number of similar products stored for each product, as in recommender.max_neighbors
+max_neighbors = 10
+
+
+def populate_neighbors(apps, schema_editor):
+    Product = apps.get_model('store', 'Product')
+    ProductNeighbor = apps.get_model('store', 'ProductNeighbor')
+    TaggedItem = apps.get_model('taggit', 'TaggedItem')
+
+    rows = dict()
+    columns = dict()
+    for product_id, tag in TaggedItem.objects.filter(content_type__app_label='store', content_type__model='product') \
+                                             .values_list('object_id', 'tag__name'):
+        rows.setdefault(product_id, []).append(tag)
+        columns.setdefault(tag, []).append(product_id)
+    active_ids = set(Product.objects.filter(is_active=True).values_list('id', flat=True))
+
+    neighbors = []
+    for product_id in Product.objects.values_list('id', flat=True):
+        shared = dict()
+        for tag in rows.get(product_id, ()):
+            for other_id in columns[tag]:
+                if other_id != product_id and other_id in active_ids:
+                    shared[other_id] = shared.get(other_id, 0) + 1
+        ranked = heapq.nsmallest(max_neighbors, shared.items(), key=lambda item: (-item[1], item[0]))
+        neighbors.extend(ProductNeighbor(product_id=product_id, neighbor_id=neighbor_id, shared_tags=shared_tags, rank=rank)
+                         for rank, (neighbor_id, shared_tags) in enumerate(ranked))
+    ProductNeighbor.objects.bulk_create(neighbors)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0034_product_rating_totals'),
+        ('taggit', '0003_taggeditem_add_unique_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductNeighbor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('shared_tags', models.PositiveIntegerField()),
+                ('rank', models.PositiveIntegerField()),
+                ('neighbor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='store.product')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='neighbors', to='store.product')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='productneighbor',
+            index=models.Index(fields=['product', 'rank'], name='store_produ_product_ae7285_idx'),
+        ),
+        migrations.RunPython(populate_neighbors, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:04
+
+from django.db import migrations, models
+
+
+def populate_react_counts(apps, schema_editor):
+    ProductReview = apps.get_model('store', 'ProductReview')
+    reviews = ProductReview.objects.annotate(actual_likes=models.Count('reacts', filter=models.Q(reacts__liked=True)),
+                                             actual_dislikes=models.Count('reacts', filter=models.Q(reacts__liked=False)))
+    for review in reviews:
+        review.likes = review.actual_likes
+        review.dislikes = review.actual_dislikes
+        review.score = review.likes - review.dislikes
+    ProductReview.objects.bulk_update(reviews, ['likes', 'dislikes', 'score'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0035_productneighbor'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='productreview',
+            name='dislikes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='productreview',
+            name='likes',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='productreview',
+            name='score',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(populate_react_counts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='productreview',
+            index=models.Index(fields=['product', '-score', '-date_posted'], name='store_produ_product_d2d24f_idx'),
+        ),
+    ]
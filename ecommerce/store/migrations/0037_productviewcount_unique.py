@@ -0,0 +1,33 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:06
+
+from django.db import migrations, models
+
+
+def merge_duplicate_view_counts(apps, schema_editor):
+    ProductViewCount = apps.get_model('store', 'ProductViewCount')
+    counters = dict()
+    for view_count in ProductViewCount.objects.order_by('id'):
+        key = (view_count.customer_id, view_count.product_id)
+        if key not in counters:
+            counters[key] = view_count
+            continue
+        kept = counters[key]
+        ProductViewCount.objects.filter(id=kept.id).update(count=models.F('count') + view_count.count,
+                                                           last_viewing=max(kept.last_viewing, view_count.last_viewing))
+        kept.last_viewing = max(kept.last_viewing, view_count.last_viewing)
+        view_count.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0036_review_react_counts'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_view_counts, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='productviewcount',
+            constraint=models.UniqueConstraint(fields=('customer', 'product'), name='One view counter per customer and product'),
+        ),
+    ]
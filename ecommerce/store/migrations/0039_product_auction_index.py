@@ -0,0 +1,17 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0038_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['selling_type', 'is_active', 'end_date'], name='store_produ_selling_fb79d8_idx'),
+        ),
+    ]
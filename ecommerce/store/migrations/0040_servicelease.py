@@ -0,0 +1,22 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0039_product_auction_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ServiceLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('holder', models.CharField(max_length=200)),
+                ('expires', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0040_servicelease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customer',
+            name='nickname',
+            field=models.CharField(db_index=True, max_length=200, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 3.1.7 on 2026-10-18 11:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('taggit', '0003_taggeditem_add_unique_index'),
+        ('store', '0041_customer_nickname_index'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                "CREATE VIRTUAL TABLE store_productsearch USING fts5(name, description, tags, seller, tokenize='unicode61 remove_diacritics 2')",
+                '''INSERT INTO store_productsearch (rowid, name, description, tags, seller)
+                   SELECT p.id, p.name, p.description,
+                          COALESCE((SELECT group_concat(t.name, ', ')
+                                    FROM taggit_taggeditem ti
+                                    JOIN taggit_tag t ON t.id = ti.tag_id
+                                    JOIN django_content_type ct ON ct.id = ti.content_type_id
+                                    WHERE ti.object_id = p.id AND ct.app_label = 'store' AND ct.model = 'product'), ''),
+                          COALESCE(c.nickname, '')
+                   FROM store_product p LEFT JOIN store_customer c ON c.id = p.seller_id''',
+            ],
+            reverse_sql='DROP TABLE store_productsearch',
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.1.7 on 2026-10-18 16:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0044_product_price_index'),
+    ]
+
+    operations = [
+        # 0042 first joined the tags of the search table rows with ' ', which search.invalidate_rows
+        # can't split back into tag names, so store them separated by ', ' as index_products does
+        migrations.RunSQL(
+            sql='''UPDATE store_productsearch
+                   SET tags = COALESCE((SELECT group_concat(t.name, ', ')
+                                        FROM taggit_taggeditem ti
+                                        JOIN taggit_tag t ON t.id = ti.tag_id
+                                        JOIN django_content_type ct ON ct.id = ti.content_type_id
+                                        WHERE ti.object_id = store_productsearch.rowid
+                                          AND ct.app_label = 'store' AND ct.model = 'product'), '')''',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
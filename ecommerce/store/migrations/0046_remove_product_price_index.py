@@ -0,0 +1,17 @@
+# Generated by Django 3.1.7 on 2026-10-18 12:01
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('store', '0045_productsearch_tag_separator'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='product',
+            name='store_produ_price_2d55a6_idx',
+        ),
+    ]
@@ -3,10 +3,14 @@ Petiverse's database model, constructed using Django's ORM system with SQLite3
 '''
 
 from __future__ import unicode_literals
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth.models import User
+from django.core.mail import EmailMessage
+from django.db.models.functions import Cast
 from django.utils import timezone
+from django.utils.functional import cached_property
 from taggit.managers import TaggableManager
+from taggit.models import TaggedItem
 from .util.generate_url_slugs import unique_slugify
 from PIL import Image
 
@@ -18,6 +22,9 @@ SELLING_CHOICES = [
 
 no_image_url = '/images/no-image.jpg'
 
+# Weight of each purchase in a customer's profile, relative to a single product view
+purchase_weight = 2.0
+
 class Customer(models.Model):
     '''
     Represents the details of a user.
@@ -25,7 +32,7 @@ class Customer(models.Model):
     '''
 
     user = models.OneToOneField(User, null=True, blank=True, on_delete=models.CASCADE)
-    nickname = models.CharField(max_length=200, null=True)
+    nickname = models.CharField(max_length=200, null=True, db_index=True)
     email = models.EmailField(max_length=254)
     contactNo = models.CharField(max_length=200, null=True)
     image = models.ImageField(default='../images/user_icon.png', upload_to='../images')
@@ -74,9 +81,23 @@ class Product(models.Model):
     slug_str = models.SlugField(blank=True)
     is_active = models.BooleanField(default=True)
     imageUri = models.TextField(blank=True)
+    # Totals of the product's reviews, kept up to date by update_rating. Saves of a loaded product
+    # must leave them out (save with update_fields) or they may write back stale totals
+    rating_sum = models.PositiveIntegerField(default=0)
+    review_count = models.PositiveIntegerField(default=0)
     
+    class Meta:
+        indexes = [
+            models.Index(fields=['selling_type', 'is_active', 'end_date'])
+        ]
+
     def save(self, **kwargs):
-        unique_slugify(self, self.name, slug_field_name='slug_str')
+        # The slug follows the name, so it is only worked out again when the name is saved
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'name' in update_fields:
+            unique_slugify(self, self.name, slug_field_name='slug_str')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'slug_str'}
         super(Product, self).save(**kwargs)
 
     def __str__(self):
@@ -97,10 +118,107 @@ class Product(models.Model):
     
     @property
     def avg_rating(self):
-        if self.reviews.count() == 0:
+        if self.review_count == 0:
             return 2.5
         else:
-            return float(self.reviews.aggregate(models.Avg('rating'))['rating__avg'])
+            return self.rating_sum / self.review_count
+
+    @staticmethod
+    def avg_rating_expression():
+        '''
+        Return a query expression calculating avg_rating from the stored review totals
+        '''
+
+        return models.Case(models.When(review_count=0, then=models.Value(2.5)),
+                           default=Cast('rating_sum', models.FloatField()) / models.F('review_count'),
+                           output_field=models.FloatField())
+
+    @staticmethod
+    def update_rating(product_id, rating_delta, count_delta=0):
+        '''
+        Atomically adjust a product's stored review totals after a review is posted, edited or deleted
+        '''
+
+        Product.objects.filter(id=product_id).update(rating_sum=models.F('rating_sum') + rating_delta,
+                                                     review_count=models.F('review_count') + count_delta)
+
+    @staticmethod
+    def place_bid(product_id, customer, amount):
+        '''
+        Make the customer the highest bidder on an auction if their bid beats the current highest bid,
+        recording the bid in the auction's bid history
+        - The bid is placed with a single conditional update, so of several concurrent bids only
+          those that are still the highest when they are written succeed, and the highest bid never goes down
+        - Fails if the auction has ended or been unlisted, or if the customer is its seller
+
+        Returns whether the bid was placed
+        '''
+
+        with transaction.atomic():
+            placed = Product.objects.filter(id=product_id, selling_type='auction', is_active=True,
+                                            end_date__gt=timezone.now(), starting_bid__lt=amount) \
+                                    .exclude(seller=customer) \
+                                    .update(starting_bid=amount, highest_bidder=customer)
+            if placed:
+                Bidder.objects.create(product_id=product_id, name=customer.nickname, price=amount)
+        return bool(placed)
+
+    @staticmethod
+    def take_stock(quantities):
+        '''
+        Move the given units of each product (a dict of product id to quantity) from remaining
+        to sold, and restart their estimated delivery dates, in a single update
+        - Returns False without changing anything if any product lacks the remaining units
+        - Must be called inside a transaction, which the caller should roll back on failure
+        '''
+
+        if not quantities:
+            return True
+
+        units = models.Case(*[models.When(id=product_id, then=quantity) for product_id, quantity in quantities.items()],
+                            default=0, output_field=models.IntegerField())
+        now = models.Value(timezone.now(), output_field=models.DateTimeField())
+
+        products = Product.objects.filter(id__in=quantities.keys())
+        products.update(remaining_unit=models.F('remaining_unit') - units,
+                        sold_unit=models.F('sold_unit') + units,
+                        estimated_date=models.ExpressionWrapper(now + models.F('delivery_period'),
+                                                                output_field=models.DateTimeField()))
+        return not products.filter(remaining_unit__lt=0).exists()
+
+    @staticmethod
+    def return_stock(product_id, quantity):
+        '''
+        Move units of a product back from sold to remaining after an order is cancelled, in a single update
+
+        Returns whether the product was sold out before, or None if it doesn't exist
+        '''
+
+        if not Product.objects.filter(id=product_id).update(remaining_unit=models.F('remaining_unit') + quantity,
+                                                            sold_unit=models.F('sold_unit') - quantity):
+            return None
+        return Product.objects.filter(id=product_id, remaining_unit=quantity).exists()
+
+    @staticmethod
+    def reconcile_ratings():
+        '''
+        Recalculate every product's stored review totals from its reviews, repairing any drift
+
+        Returns the number of products that were repaired
+        '''
+
+        products = Product.objects.annotate(actual_sum=models.Sum('reviews__rating'), actual_count=models.Count('reviews')) \
+                                  .only('id', 'rating_sum', 'review_count')
+        repaired = []
+        for product in products:
+            actual_sum = product.actual_sum or 0
+            if product.rating_sum != actual_sum or product.review_count != product.actual_count:
+                product.rating_sum = actual_sum
+                product.review_count = product.actual_count
+                repaired.append(product)
+
+        Product.objects.bulk_update(repaired, ['rating_sum', 'review_count'])
+        return len(repaired)
     
     @property
     def bidder_count(self):
@@ -136,14 +254,51 @@ class ProductReview(models.Model):
     rating = models.PositiveIntegerField(blank=False)
     text = models.TextField(max_length=1000, blank=False)
 
+    # Counts of the review's reacts, kept up to date by update_reacts
+    likes = models.PositiveIntegerField(default=0)
+    dislikes = models.PositiveIntegerField(default=0)
+    score = models.IntegerField(default=0)
+
     class Meta:
         constraints = [
             models.UniqueConstraint(fields=['product', 'author'], name='User can only leave one review per product')
         ]
+        indexes = [
+            models.Index(fields=['product', '-score', '-date_posted'])
+        ]
 
-    @property
-    def score(self):
-        return self.reacts.filter(liked=True).count() - self.reacts.filter(liked=False).count()
+    @staticmethod
+    def update_reacts(review_id, like_delta, dislike_delta):
+        '''
+        Atomically adjust a review's react counts and score (likes minus dislikes) after a react changes
+        '''
+
+        ProductReview.objects.filter(id=review_id).update(likes=models.F('likes') + like_delta,
+                                                          dislikes=models.F('dislikes') + dislike_delta,
+                                                          score=models.F('score') + like_delta - dislike_delta)
+
+    @staticmethod
+    def reconcile_reacts():
+        '''
+        Recalculate every review's react counts and score from its reacts, repairing any drift
+
+        Returns the number of reviews that were repaired
+        '''
+
+        reviews = ProductReview.objects.annotate(actual_likes=models.Count('reacts', filter=models.Q(reacts__liked=True)),
+                                                 actual_dislikes=models.Count('reacts', filter=models.Q(reacts__liked=False))) \
+                                       .only('id', 'likes', 'dislikes', 'score')
+        repaired = []
+        for review in reviews:
+            if review.likes != review.actual_likes or review.dislikes != review.actual_dislikes \
+                    or review.score != review.actual_likes - review.actual_dislikes:
+                review.likes = review.actual_likes
+                review.dislikes = review.actual_dislikes
+                review.score = review.likes - review.dislikes
+                repaired.append(review)
+
+        ProductReview.objects.bulk_update(repaired, ['likes', 'dislikes', 'score'])
+        return len(repaired)
     
     @property
     def timestamp(self):
@@ -174,17 +329,22 @@ class Order(models.Model):
 	def __str__(self):
 		return str(self.id)
 
+	@cached_property
+	def cart_totals(self):
+		'''
+		Number of items in the order and their total price, calculated in one query and
+		kept for the lifetime of this instance
+		'''
+
+		return OrderItem.summarize(self.orderitem_set.all())
+
 	@property
 	def get_cart_total(self):
-		orderitems = self.orderitem_set.all()
-		total = sum([item.get_total for item in orderitems])
-		return total 
+		return self.cart_totals['total']
 
 	@property
 	def get_cart_items(self):
-		orderitems = self.orderitem_set.all()
-		total = sum([item.quantity for item in orderitems])
-		return total 
+		return self.cart_totals['items']
         
 
 class OrderItem(models.Model):
@@ -206,6 +366,22 @@ class OrderItem(models.Model):
             total = self.product.starting_bid
         return total
 
+    @staticmethod
+    def summarize(order_items):
+        '''
+        Return the total quantity and total price of a queryset of order items as a dict with
+        keys 'items' and 'total', using the same pricing as get_total in a single query
+        - Sale items cost their price per unit, auction items cost the winning bid
+        '''
+
+        totals = order_items.aggregate(
+            items=models.Sum('quantity'),
+            total=models.Sum(models.Case(
+                models.When(product__selling_type='sale', then=models.F('product__price') * models.F('quantity')),
+                default=models.F('product__starting_bid'),
+                output_field=models.DecimalField(max_digits=30, decimal_places=2))))
+        return {'items': totals['items'] or 0, 'total': totals['total'] or 0}
+
 class ShippingAddress(models.Model):
     '''
     Shipping address attached to purchases
@@ -235,20 +411,56 @@ class ProductViewCount(models.Model):
     count = models.PositiveIntegerField(default=0)
     last_viewing = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['customer', 'product'], name='One view counter per customer and product')
+        ]
+
     @staticmethod
     def log(customer, product):
         ''' 
         Log the viewing of a product by a customer.
-        Returns the number of times the given product has been viewed by the customer
+        - The view is buffered and written in the background (see viewlog.py), so it may take
+          a few seconds to appear in the database
         '''
 
-        view_counter, created = ProductViewCount.objects.get_or_create(
-                                    customer=customer,
-                                    product=product)
-        view_counter.count += 1
-        view_counter.save()
+        from .viewlog import view_log
+        view_log.add(customer.id, product.id)
+
+    @staticmethod
+    def save_views(views):
+        '''
+        Add a batch of buffered views, given as (customer_id, product_id, count, last_viewing) rows,
+        to the view counters and the customers' profiles in one transaction
+        - Counters are upserted with a single statement that increments the stored count, so
+          concurrent batches for the same counter are all kept
+        - Views of customers or products deleted since they were buffered are dropped
+        '''
 
-        return view_counter.count
+        table = ProductViewCount._meta.db_table
+        customer, product, count, last_viewing = (ProductViewCount._meta.get_field(name).column
+                                                  for name in ('customer', 'product', 'count', 'last_viewing'))
+        sql = f'''INSERT INTO {table} ({customer}, {product}, {count}, {last_viewing}) VALUES (%s, %s, %s, %s)
+                  ON CONFLICT ({customer}, {product}) DO UPDATE
+                  SET {count} = {table}.{count} + excluded.{count},
+                      {last_viewing} = CASE WHEN excluded.{last_viewing} > {table}.{last_viewing}
+                                            THEN excluded.{last_viewing} ELSE {table}.{last_viewing} END'''
+
+        with transaction.atomic():
+            customers = Customer.objects.in_bulk({row[0] for row in views})
+            product_ids = set(Product.objects.filter(id__in={row[1] for row in views}).values_list('id', flat=True))
+            views = [row for row in views if row[0] in customers and row[1] in product_ids]
+
+            connection = transaction.get_connection()
+            with connection.cursor() as cursor:
+                cursor.executemany(sql, [(customer_id, product_id, view_count, connection.ops.adapt_datetimefield_value(viewed))
+                                         for customer_id, product_id, view_count, viewed in views])
+
+            viewed_products = dict()
+            for customer_id, product_id, view_count, _ in views:
+                viewed_products.setdefault(customer_id, []).extend([product_id] * view_count)
+            for customer_id, viewed_ids in viewed_products.items():
+                CustomerProfile.add_products(customers[customer_id], viewed_ids, 1)
 
     def __str__(self):
         return f'Customer: {self.customer}, Product: {self.product}, Count: {self.count}'
@@ -266,14 +478,282 @@ class Wishlist(models.Model):
 
     @staticmethod
     def check_exist(wishlist, product):
-        products = wishlist.product.all()
-        result = False
-        for item in products:
-            if product == item:
-                result = True
-                break
-        
-        return result
+        return wishlist.product.filter(id=product.id).exists()
+
+    @staticmethod
+    def get_product_ids(customer):
+        '''
+        Return the set of ids of the products in the customer's wishlist
+        '''
+
+        return set(Wishlist.product.through.objects.filter(wishlist__customer=customer)
+                                                   .values_list('product_id', flat=True))
     
     def __str__(self):
-        return f"{self.customer}'s wishlist"
\ No newline at end of file
+        return f"{self.customer}'s wishlist"
+
+class ProductNeighbor(models.Model):
+    '''
+    Links a product to one of the active listings sharing the most tags with it, shown as
+    a similar item on its product page
+    - Rank 0 is the most similar neighbor
+    - Neighbors are kept up to date by the recommender's refresh_neighbors, and can be
+      rebuilt with the rebuild_neighbors command
+    '''
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='neighbors')
+    neighbor = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    shared_tags = models.PositiveIntegerField()
+    rank = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product', 'rank'])
+        ]
+
+    @staticmethod
+    def get_similar(product, max_results):
+        '''
+        Return a list of the most similar active products to a product, using a single query
+        '''
+
+        neighbors = ProductNeighbor.objects.filter(product=product, neighbor__is_active=True) \
+                                           .select_related('neighbor').order_by('rank')[:max_results]
+        return [neighbor.neighbor for neighbor in neighbors]
+
+    def __str__(self):
+        return f'{self.product} neighbor #{self.rank}: {self.neighbor}'
+
+def get_product_tags(product_ids=None):
+    '''
+    Return a dict of product id to the names of the product's tags using a single query
+    - Leave product_ids as None to load the tags of every product
+    '''
+
+    rows = TaggedItem.objects.filter(content_type__app_label='store', content_type__model='product')
+    if product_ids is not None:
+        rows = rows.filter(object_id__in=set(product_ids))
+
+    product_tags = dict()
+    for product_id, tag in rows.order_by('object_id').values_list('object_id', 'tag__name'):
+        product_tags.setdefault(product_id, []).append(tag)
+    return product_tags
+
+class CustomerProfile(models.Model):
+    '''
+    Materialized tag profile of a customer, read by the recommender
+    - weights maps each tag name to the customer's interest in it, built from product views
+      (1 per view) and purchases ('purchase_weight' per ordered item)
+    - sq_norm caches the sum of the squared weights
+    - Profiles are updated by small deltas through add_products, and can be rebuilt from
+      the viewing and purchase history with rebuild (see the rebuild_profiles command)
+    '''
+
+    customer = models.OneToOneField(Customer, on_delete=models.CASCADE, related_name='profile')
+    weights = models.JSONField(default=dict)
+    sq_norm = models.FloatField(default=0)
+
+    def set_weights(self, weights):
+        self.weights = {tag: weight for tag, weight in weights.items() if weight > 0}
+        self.sq_norm = sum(weight ** 2 for weight in self.weights.values())
+
+    @staticmethod
+    def add_products(customer, product_ids, weight):
+        '''
+        Add 'weight' to the customer's interest in every tag of the given products.
+        A product id may be repeated to count it more than once, and a negative weight
+        removes interest (eg. when a purchase is cancelled)
+        - Must be called after the view or order it reflects has been saved, as a customer
+          without a profile has theirs rebuilt from their history instead
+        '''
+
+        deltas = dict()
+        product_tags = get_product_tags(product_ids)
+        for product_id in product_ids:
+            for tag in product_tags.get(product_id, []):
+                deltas[tag] = deltas.get(tag, 0) + weight
+        if not deltas:
+            return
+
+        with transaction.atomic():
+            profile = CustomerProfile.objects.select_for_update().filter(customer=customer).first()
+            if profile is None:
+                CustomerProfile.rebuild([customer.id])
+                return
+
+            weights = dict(profile.weights)
+            for tag, delta in deltas.items():
+                weights[tag] = float(weights.get(tag, 0) + delta)
+            profile.set_weights(weights)
+            profile.save()
+
+    @staticmethod
+    def rebuild(customer_ids=None):
+        '''
+        Recalculate the profiles of the given customers (or of every customer if None) from their
+        viewing and purchase history, using a fixed number of queries
+
+        Returns the number of profiles rebuilt
+        '''
+
+        views = ProductViewCount.objects.filter(customer__isnull=False, product__isnull=False)
+        purchases = OrderItem.objects.filter(order__customer__isnull=False, order__complete=True, product__isnull=False)
+        profiles = CustomerProfile.objects.all()
+        if customer_ids is not None:
+            views = views.filter(customer_id__in=customer_ids)
+            purchases = purchases.filter(order__customer_id__in=customer_ids)
+            profiles = profiles.filter(customer_id__in=customer_ids)
+        views = list(views.values_list('customer_id', 'product_id', 'count'))
+        purchases = list(purchases.values_list('order__customer_id', 'product_id'))
+
+        if customer_ids is None:
+            customer_ids = Customer.objects.values_list('id', flat=True)
+            product_tags = get_product_tags()
+        else:
+            product_tags = get_product_tags([row[1] for row in views] + [row[1] for row in purchases])
+
+        weights = {customer_id: dict() for customer_id in customer_ids}
+        for customer_id, product_id, count in views:
+            for tag in product_tags.get(product_id, []):
+                weights[customer_id][tag] = float(weights[customer_id].get(tag, 0) + count)
+        for customer_id, product_id in purchases:
+            for tag in product_tags.get(product_id, []):
+                weights[customer_id][tag] = float(weights[customer_id].get(tag, 0) + purchase_weight)
+
+        new_profiles = []
+        for customer_id, customer_weights in weights.items():
+            profile = CustomerProfile(customer_id=customer_id)
+            profile.set_weights(customer_weights)
+            new_profiles.append(profile)
+
+        with transaction.atomic():
+            profiles.delete()
+            CustomerProfile.objects.bulk_create(new_profiles)
+
+        return len(new_profiles)
+
+    def __str__(self):
+        return f"{self.customer}'s profile"
+
+class OutgoingEmail(models.Model):
+    '''
+    An email waiting in the outbox to be delivered by the send_emails command
+    - Views enqueue emails instead of sending them, so requests never wait on the mail server
+    - A worker claims a batch of due emails by writing its claim token, which also pushes
+      next_attempt back so that no other worker picks them up while they are being sent
+    - Failed emails are retried with an increasing delay until max_attempts is reached
+    '''
+
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    recipients = models.JSONField(default=list)
+    created = models.DateTimeField(auto_now_add=True)
+    next_attempt = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    claim = models.CharField(max_length=32, blank=True)
+    sent = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['sent', 'next_attempt'])
+        ]
+
+    @staticmethod
+    def enqueue(messages):
+        '''
+        Add a list of EmailMessage objects to the outbox
+        '''
+
+        OutgoingEmail.objects.bulk_create([OutgoingEmail(subject=message.subject,
+                                                         body=message.body,
+                                                         from_email=message.from_email,
+                                                         recipients=message.recipients())
+                                           for message in messages])
+
+    def to_message(self, connection=None):
+        return EmailMessage(self.subject, self.body, self.from_email, self.recipients, connection=connection)
+
+    def __str__(self):
+        return f"{self.subject} to {', '.join(self.recipients)}"
+
+class ServiceLease(models.Model):
+    '''
+    A lease held by the one process allowed to run a background service (eg. closing auctions)
+    - The holder must renew the lease before it expires, after which any other process may take it over
+    '''
+
+    name = models.CharField(max_length=100, unique=True)
+    holder = models.CharField(max_length=200)
+    expires = models.DateTimeField()
+
+    @staticmethod
+    def acquire(name, holder, duration):
+        '''
+        Take or renew the lease on the named service for 'duration' (a timedelta)
+
+        Returns whether 'holder' now holds the lease
+        '''
+
+        now = timezone.now()
+        if ServiceLease.objects.filter(name=name).filter(models.Q(holder=holder) | models.Q(expires__lte=now)) \
+                               .update(holder=holder, expires=now + duration):
+            return True
+        try:
+            with transaction.atomic():
+                ServiceLease.objects.create(name=name, holder=holder, expires=now + duration)
+        except IntegrityError:
+            return False
+        return True
+
+    @staticmethod
+    def release(name, holder):
+        ServiceLease.objects.filter(name=name, holder=holder).delete()
+
+    def __str__(self):
+        return f'{self.name} held by {self.holder} until {self.expires}'
+
+class SharedCounter(models.Model):
+    '''
+    A named counter shared by every process through the database
+    - Used as generation numbers telling processes that data they hold in memory or in a
+      per-process cache is stale (see recommender.get_generation), and for statistics
+    - A counter that was never incremented reads as 0
+    '''
+
+    name = models.CharField(max_length=255, unique=True)
+    value = models.BigIntegerField(default=0)
+
+    @staticmethod
+    def get_values(names):
+        '''
+        Return a dict of each of the given counter names to its value, with a single query
+        '''
+
+        values = dict.fromkeys(names, 0)
+        if values:
+            values.update(SharedCounter.objects.filter(name__in=list(values)).values_list('name', 'value'))
+        return values
+
+    @staticmethod
+    def increment(amounts):
+        '''
+        Add to several counters (a dict of name to amount), creating the missing ones
+        - Counters are upserted with a single statement that adds to the stored value, so
+          concurrent increments of the same counter are all kept
+        - All the counters are written in one transaction, as there can be thousands of them
+          (see search.invalidate_rows)
+        '''
+
+        if not amounts:
+            return
+
+        table = SharedCounter._meta.db_table
+        sql = f'''INSERT INTO {table} (name, value) VALUES (%s, %s)
+                  ON CONFLICT (name) DO UPDATE SET value = {table}.value + excluded.value'''
+        with transaction.atomic(), transaction.get_connection().cursor() as cursor:
+            cursor.executemany(sql, list(amounts.items()))
+
+    def __str__(self):
+        return f'{self.name}: {self.value}'
@@ -1,6 +1,336 @@
+import atexit
+import bisect
+import heapq
 import math
+import threading
+import time
+from array import array
 
-from .models import Product, Customer, ProductViewCount, Order, OrderItem
+from django.core.cache import caches
+from django.core.paginator import Paginator
+from django.db import transaction
+
+from .models import Product, CustomerProfile, ProductNeighbor, SharedCounter, get_product_tags
+
+# Shared counter used to tell every process that product tags have changed
+tag_matrix_version_key = 'recommender:tag_matrix_version'
+# Shared counter holding the generation of every customer's cached recommendations
+recommendations_generation_key = 'recommender:recommendations_generation'
+# Shared counter holding the generation of the cached guest ranking
+guest_generation_key = 'recommender:guest_generation'
+# Number of top ranked product ids kept in each cached ranking
+max_cached_ids = 90
+# Maximum number of seconds cache hits and misses are counted in memory before being added
+# to the shared counters
+stats_flush_interval = 10
+# Number of similar products stored for each product - should be at least max_similar in views.py
+max_neighbors = 10
+
+def get_generation(key):
+    '''
+    Return the current generation of the data named by 'key'
+    - Generations are shared counters in the database, so a change made by any process
+      (eg. a web worker or a management command) is seen by every other process
+    '''
+
+    return SharedCounter.get_values([key])[key]
+
+def new_generation(key):
+    '''
+    Move the data named by 'key' to a new generation, making data tied to the old one stale
+    - The generation only changes once the current transaction commits, so that no process
+      can cache data read before the change under the new generation
+    '''
+
+    transaction.on_commit(lambda: SharedCounter.increment({key: 1}))
+
+class TagMatrix():
+    '''
+    In-process sparse product x tag matrix, used to score the whole catalog in one pass
+    - Every product tag has a weight of 1, so the matrix is stored column-wise as a sorted
+      array of product ids per tag, and row-wise as the list of each product's tags
+    - When tags change, update_products patches the changed products' rows and columns in this
+      process, and bumps a shared counter so that other processes rebuild their matrix the next
+      time they read it (see get_generation)
+    - Patches replace the data tuple rather than mutating it, so that readers holding the
+      previous tuple outside the lock are unaffected
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.data = (dict(), dict())
+
+    def update_products(self, product_ids):
+        '''
+        Reload the tags of the given products (eg. after their tags changed or they were deleted)
+        into this process's matrix with one query, and make every other process rebuild theirs
+        once the current transaction commits
+        '''
+
+        product_ids = set(product_ids)
+        if not product_ids:
+            return
+        product_tags = get_product_tags(product_ids)
+        with self.lock:
+            if self.version is not None:
+                self.data = self.patch(product_ids, product_tags)
+
+        def bump():
+            known_version = self.version
+            SharedCounter.increment({tag_matrix_version_key: 1})
+            version = get_generation(tag_matrix_version_key)
+            with self.lock:
+                # Keep the patched matrix unless another process also changed tags meanwhile
+                if known_version is not None and self.version == known_version and version == known_version + 1:
+                    self.version = version
+
+        transaction.on_commit(bump)
+
+    def patch(self, product_ids, product_tags):
+        '''
+        Return a copy of the matrix with the rows of the given products replaced by their tags in
+        product_tags, and the columns of the tags they gained or lost updated to match
+        '''
+
+        columns, rows = self.data
+        columns, rows = dict(columns), dict(rows)
+        copied = set()
+        for product_id in product_ids:
+            old_tags = set(rows.pop(product_id, ()))
+            new_tags = product_tags.get(product_id, [])
+            if new_tags:
+                rows[product_id] = new_tags
+            for tag in old_tags.symmetric_difference(new_tags):
+                if tag not in copied:
+                    columns[tag] = array('q', columns.get(tag, ()))
+                    copied.add(tag)
+                if tag in old_tags:
+                    columns[tag].remove(product_id)
+                else:
+                    bisect.insort(columns[tag], product_id)
+        for tag in copied:
+            if not columns[tag]:
+                del columns[tag]
+        return columns, rows
+
+    def build(self):
+        '''
+        Load the tags of every product with a single query
+
+        Returns a tuple of the columns and rows of the matrix
+        '''
+
+        rows = get_product_tags()
+        columns = dict()
+        for product_id, tags in rows.items():
+            for tag in tags:
+                columns.setdefault(tag, array('q')).append(product_id)
+
+        return columns, rows
+
+    def get(self):
+        '''
+        Return a tuple of the columns (tag -> product ids) and rows (product id -> tags)
+        of the matrix, rebuilding it first if tags have changed since it was last built
+        '''
+
+        version = get_generation(tag_matrix_version_key)
+        with self.lock:
+            if self.version != version:
+                self.data = self.build()
+                self.version = version
+            return self.data
+
+    def similarities(self, profile_dict, sq_norm):
+        '''
+        Return the cosine similarity between a profile and every product sharing a tag with it,
+        as a dict of product id to similarity. Products missing from the dict have zero similarity
+        - sq_norm is the sum of the profile's squared weights (see CustomerProfile)
+        '''
+
+        # Return zero similarity for every product if the profile has no tags (eg. new users)
+        if all(count==0 for count in profile_dict.values()):
+            return dict()
+
+        columns, rows = self.get()
+        numerators = dict()
+        for tag, count in profile_dict.items():
+            for product_id in columns.get(tag, ()):
+                numerators[product_id] = numerators.get(product_id, 0.0) + count
+
+        return {product_id: float(numerator) / math.sqrt(len(rows[product_id])*sq_norm)
+                for product_id, numerator in numerators.items()}
+
+tag_matrix = TagMatrix()
+
+def find_neighbors(product_id, columns, rows, active_ids):
+    '''
+    Return the 'max_neighbors' active products sharing the most tags with a product, as a
+    ranked list of (product id, number of shared tags), with ties broken by product id
+    '''
+
+    shared = dict()
+    for tag in rows.get(product_id, ()):
+        for other_id in columns[tag]:
+            if other_id != product_id and other_id in active_ids:
+                shared[other_id] = shared.get(other_id, 0) + 1
+
+    return heapq.nsmallest(max_neighbors, shared.items(), key=lambda item: (-item[1], item[0]))
+
+def save_neighbors(neighbor_lists):
+    '''
+    Replace the stored neighbors of each product in a dict of product id to ranked neighbor list
+    '''
+
+    new_neighbors = [ProductNeighbor(product_id=product_id, neighbor_id=neighbor_id, shared_tags=shared_tags, rank=rank)
+                     for product_id, neighbors in neighbor_lists.items()
+                     for rank, (neighbor_id, shared_tags) in enumerate(neighbors)]
+    with transaction.atomic():
+        ProductNeighbor.objects.filter(product_id__in=list(neighbor_lists)).delete()
+        ProductNeighbor.objects.bulk_create(new_neighbors)
+
+def rebuild_neighbors():
+    '''
+    Recalculate the stored neighbors of every product
+
+    Returns the number of products whose neighbors were rebuilt
+    '''
+
+    columns, rows = tag_matrix.get()
+    active_ids = set(Product.objects.filter(is_active=True).values_list('id', flat=True))
+    neighbor_lists = {product_id: find_neighbors(product_id, columns, rows, active_ids)
+                      for product_id in Product.objects.values_list('id', flat=True)}
+
+    with transaction.atomic():
+        ProductNeighbor.objects.all().delete()
+        save_neighbors(neighbor_lists)
+    return len(neighbor_lists)
+
+def refresh_neighbors(product_id, listed_by=()):
+    '''
+    Update the stored neighbors affected by a change to a product's tags or listing status,
+    or by its deletion
+    - The product's own neighbors are recalculated
+    - Products that listed it are recalculated, as it may have dropped down or out of their list
+    - Products sharing a tag with it have it inserted if it now ranks among their neighbors
+    - listed_by gives extra products known to have listed it (eg. before it was deleted)
+    '''
+
+    columns, rows = tag_matrix.get()
+    active_ids = set(Product.objects.filter(is_active=True).values_list('id', flat=True))
+    product_tags = set(rows.get(product_id, ()))
+
+    affected = {other_id for tag in product_tags for other_id in columns[tag]}
+    affected.update(ProductNeighbor.objects.filter(neighbor_id=product_id).values_list('product_id', flat=True))
+    affected.update(listed_by)
+    affected.discard(product_id)
+
+    stored = {other_id: [] for other_id in affected}
+    for other_id, neighbor_id, shared_tags in ProductNeighbor.objects.filter(product_id__in=affected) \
+                                                                     .order_by('product_id', 'rank') \
+                                                                     .values_list('product_id', 'neighbor_id', 'shared_tags'):
+        stored[other_id].append((neighbor_id, shared_tags))
+
+    neighbor_lists = dict()
+    if Product.objects.filter(id=product_id).exists():
+        neighbor_lists[product_id] = find_neighbors(product_id, columns, rows, active_ids)
+    for other_id, neighbors in stored.items():
+        if not neighbors or any(neighbor_id == product_id for neighbor_id, _ in neighbors):
+            neighbor_lists[other_id] = find_neighbors(other_id, columns, rows, active_ids)
+        elif product_id in active_ids:
+            shared_tags = len(product_tags.intersection(rows.get(other_id, ())))
+            candidates = neighbors + [(product_id, shared_tags)]
+            ranked = heapq.nsmallest(max_neighbors, candidates, key=lambda item: (-item[1], item[0]))
+            if shared_tags and ranked != neighbors:
+                neighbor_lists[other_id] = ranked
+
+    save_neighbors(neighbor_lists)
+
+class RecommendationCache():
+    '''
+    Cache of each customer's ranked recommendations, kept in the 'recommendations' cache
+    (see settings.CACHES, whose MAX_ENTRIES and TIMEOUT cap its size - the least recently used
+    entries are evicted first)
+    - An entry holds the number of products that can be recommended and the ids of the top
+      'max_cached_ids' of them, in ranked order. Guests share a single entry (customer_id None)
+      holding the whole guest ranking
+    - Entries are dropped for one customer when their profile changes, and for everyone when a
+      product's tags, availability or rating changes (see signals.py). The guest ranking does not
+      depend on tags, so it is only dropped when availability or ratings change
+    - Entries are stored per process, but are keyed by generations shared by every process (see
+      get_generation), so invalidating them from any process drops them everywhere
+    - Hits and misses are counted in memory and added to shared counters at most every
+      'stats_flush_interval' seconds. They can be read from any process with stats() (see the
+      recommendation_stats command)
+    '''
+
+    hits_key = 'recommender:cache_hits'
+    misses_key = 'recommender:cache_misses'
+
+    def __init__(self, alias='recommendations'):
+        self.alias = alias
+        self.lock = threading.Lock()
+        self.pending_counts = dict()
+        self.last_flush = time.monotonic()
+
+    def get_key(self, customer_id):
+        if customer_id is None:
+            return f'ranking:guest:{get_generation(guest_generation_key)}'
+        customer_key = f'recommender:customer_generation:{customer_id}'
+        generations = SharedCounter.get_values([recommendations_generation_key, customer_key])
+        return f'ranking:{customer_id}:{generations[recommendations_generation_key]}:{generations[customer_key]}'
+
+    def count(self, key):
+        with self.lock:
+            self.pending_counts[key] = self.pending_counts.get(key, 0) + 1
+            if time.monotonic() - self.last_flush < stats_flush_interval:
+                return
+        self.flush_counts()
+
+    def flush_counts(self):
+        '''
+        Add the hits and misses counted in this process to the shared counters
+        '''
+
+        with self.lock:
+            counts, self.pending_counts = self.pending_counts, dict()
+            self.last_flush = time.monotonic()
+        SharedCounter.increment(counts)
+
+    def get(self, customer_id):
+        '''
+        Return the customer's cached entry as a dict with 'count' and 'ids' keys, or None on a miss
+        '''
+
+        entry = caches[self.alias].get(self.get_key(customer_id))
+        self.count(self.misses_key if entry is None else self.hits_key)
+        return entry
+
+    def set(self, customer_id, count, ids):
+        caches[self.alias].set(self.get_key(customer_id), {'count': count, 'ids': list(ids)})
+
+    def invalidate_customer(self, customer_id):
+        new_generation(f'recommender:customer_generation:{customer_id}')
+
+    def invalidate_all(self):
+        new_generation(recommendations_generation_key)
+
+    def invalidate_guest(self):
+        new_generation(guest_generation_key)
+
+    def stats(self):
+        '''
+        Return the number of cache hits and misses counted by every process, and the hit rate
+        '''
+
+        self.flush_counts()
+        counts = SharedCounter.get_values([self.hits_key, self.misses_key])
+        hits, misses = counts[self.hits_key], counts[self.misses_key]
+        return {'hits': hits, 'misses': misses, 'hit_rate': hits / (hits + misses) if hits + misses else 0.0}
+
+recommendation_cache = RecommendationCache()
+atexit.register(recommendation_cache.flush_counts)
 
 class Recommender():
     '''
@@ -11,31 +341,25 @@ class Recommender():
 
     def __init__(self, customer=None):
         self.customer = customer
-        self.profile_dict = self.get_customer_profile()
+        self.profile_dict, self.profile_sq_norm = self.get_customer_profile()
 
-    def get_customer_profile(self, purchase_weight=2.0):
+    def get_customer_profile(self):
         '''
-        Generate the customers's profile using their viewing and purchase history
+        Read the customer's profile, which is built from their viewing and purchase history
+        (see CustomerProfile). Customers without a stored profile have theirs built first
+
+        Returns a tuple of the profile dict and the sum of its squared weights
         '''
 
         # Return empty profile dict for guest user
         if not self.customer:
-            return dict()
+            return dict(), 0.0
 
-        # Add to profile based on viewed items
-        viewed = ProductViewCount.objects.filter(customer=self.customer)
-        profile = dict()
-        for item in viewed:
-            for tag in item.product.tags.names():
-                profile[tag] = float(profile.get(tag, 0) + item.count)
-
-        # Add to profile based on purchases.
-        orders = Order.objects.filter(customer=self.customer, complete=True)
-        purchases = OrderItem.objects.filter(order__in=orders)
-        for order_item in purchases:
-            if not order_item.product is None: # Check product not deleted
-                for tag in order_item.product.tags.names():
-                    profile[tag] = float(profile.get(tag, 0) + (1 * purchase_weight))
+        profiles = CustomerProfile.objects.filter(customer=self.customer).values_list('weights', 'sq_norm')
+        profile = profiles.first()
+        if profile is None:
+            CustomerProfile.rebuild([self.customer.id])
+            profile = profiles.first()
 
         return profile
 
@@ -64,8 +388,19 @@ class Recommender():
         
         return float(numerator) / math.sqrt(denom_a*denom_b)
 
-  
+    @staticmethod
+    def weighted_score(similarity, n_reviews, avg_rating, max_rating_weight=0.3, max_reviews=5, max_rating=5):
+        '''
+        Combine a product's similarity with its review score - see calculate_score
+        '''
+
+        # Calculate weighting of reviews versus similarity
+        n_reviews_clamped = max(0, min(n_reviews, max_reviews))
+        max_reviews_fraction = n_reviews_clamped / float(max_reviews)
+        rating_weight = max_rating_weight * max_reviews_fraction
+        similarity_weight = 1 - rating_weight
 
+        return (similarity * similarity_weight) + ((avg_rating / max_rating) * rating_weight)
 
     def calculate_score(self, product, max_rating_weight=0.3, max_reviews=5, max_rating=5):
         '''
@@ -86,21 +421,144 @@ class Recommender():
         if not self.customer:
             return product.avg_rating / max_rating
 
-        # Calculate weighting of reviews versus similarity
-        n_reviews_clamped = max(0, min(product.reviews.count(), max_reviews))
-        max_reviews_fraction = n_reviews_clamped / float(max_reviews)
-        rating_weight = max_rating_weight * max_reviews_fraction
-        similarity_weight = 1 - rating_weight
+        return self.weighted_score(self.calculate_similarity(product), product.review_count, product.avg_rating,
+                                   max_rating_weight, max_reviews, max_rating)
 
-        return (self.calculate_similarity(product) * similarity_weight) + ((product.avg_rating / max_rating) * rating_weight)
+    def score_products(self, candidates, max_rating=5):
+        '''
+        Calculate the recommender score of a batch of products at once - see calculate_score
+        - Candidates are (id, number of reviews, sum of ratings) rows, as returned by get_candidates
+        - Similarities for the whole batch come from a single pass over the tag matrix
+
+        Returns a dict of product id to score, in the same order as the candidates
+        '''
+
+        scores = dict()
+        if not self.customer:
+            for product_id, n_reviews, rating_sum in candidates:
+                scores[product_id] = self.candidate_avg_rating(n_reviews, rating_sum) / max_rating
+            return scores
+
+        similarities = tag_matrix.similarities(self.profile_dict, self.profile_sq_norm)
+        for product_id, n_reviews, rating_sum in candidates:
+            scores[product_id] = self.weighted_score(similarities.get(product_id, 0.0), n_reviews,
+                                                     self.candidate_avg_rating(n_reviews, rating_sum))
+        return scores
+
+    @staticmethod
+    def candidate_avg_rating(n_reviews, rating_sum):
+        '''
+        Equivalent of Product.avg_rating for a row returned by get_candidates
+        '''
+
+        if n_reviews == 0:
+            return 2.5
+        return rating_sum / n_reviews
+
+    @staticmethod
+    def get_guest_ranking(max_results):
+        '''
+        Return the ids of the top 'max_results' products for guests, ranked by their average
+        rating (see calculate_score) with a single query
+        '''
+
+        return list(Product.objects.filter(remaining_unit__gt=0, is_active=True)
+                                   .annotate(rating=Product.avg_rating_expression())
+                                   .order_by('-rating', 'id')
+                                   .values_list('id', flat=True)[:max_results])
+
+    @staticmethod
+    def get_candidates():
+        '''
+        Return the products that can be recommended as (id, number of reviews, sum of ratings) rows,
+        so that scoring them needs no further queries
+        '''
+
+        return Product.objects.filter(remaining_unit__gt=0, is_active=True) \
+                              .order_by('id') \
+                              .values_list('id', 'review_count', 'rating_sum')
+
+    def get_ranked_ids(self, n, scores=None):
+        '''
+        Return the ids of the 'n' highest scoring products, using a heap bounded by 'n' rather
+        than sorting every candidate. Ties keep the candidates' order, as with a stable sort
+        '''
+
+        if scores is None:
+            scores = self.score_products(self.get_candidates())
+        return heapq.nlargest(n, scores, key=scores.get)
 
-    
     def get_recommended_products(self, max_results=1000):
         '''
         Return a list of the products most similar to the user's profile, that still have units left
         '''
 
-        products = Product.objects.filter(remaining_unit__gt=0, is_active=True)
-        
-        products = sorted(products, key=lambda p: self.calculate_score(p), reverse=True)
-        return products[:max_results]
+        return RecommendedProducts(self, max_results)[:max_results]
+
+    def get_recommended_page(self, page_number, page_size, max_results=1000):
+        '''
+        Return a page of the recommended products, as returned by Paginator.get_page.
+        Only the products up to the end of the requested page are ranked, and only the
+        products on the page are loaded
+        '''
+
+        return Paginator(RecommendedProducts(self, max_results), page_size).get_page(page_number)
+
+class RecommendedProducts():
+    '''
+    Lazily ranked sequence of a recommender's top 'max_results' products, which can be
+    handed to a Paginator
+    - A customer's ranking is read from the recommendation cache when possible, otherwise the
+      candidates are scored once and the top 'max_cached_ids' are cached
+    - Guests are all served the same precomputed ranking, which is cached in full
+    - Slicing ranks only the products up to the end of the slice and loads only the
+      products within it
+    '''
+
+    def __init__(self, recommender, max_results):
+        self.recommender = recommender
+        self.max_results = max_results
+        self.scores = None
+        self.entry = None
+
+    def get_scores(self):
+        if self.scores is None:
+            self.scores = self.recommender.score_products(self.recommender.get_candidates())
+        return self.scores
+
+    def get_entry(self):
+        '''
+        Return the number of candidates and the top ranked ids, from the cache when possible
+        '''
+
+        customer_id = self.recommender.customer.id if self.recommender.customer else None
+        if self.entry is None:
+            self.entry = recommendation_cache.get(customer_id)
+        if self.entry is None:
+            if customer_id is None:
+                ids = self.recommender.get_guest_ranking(self.max_results)
+                self.entry = {'count': len(ids), 'ids': ids}
+            else:
+                scores = self.get_scores()
+                self.entry = {'count': len(scores), 'ids': self.recommender.get_ranked_ids(max_cached_ids, scores)}
+            recommendation_cache.set(customer_id, self.entry['count'], self.entry['ids'])
+        return self.entry
+
+    def get_ranked_ids(self, stop):
+        entry = self.get_entry()
+        if stop <= len(entry['ids']) or len(entry['ids']) == entry['count']:
+            return entry['ids'][:stop]
+        return self.recommender.get_ranked_ids(stop, self.get_scores())
+
+    def __len__(self):
+        return min(self.get_entry()['count'], self.max_results)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+
+        start, stop, step = index.indices(len(self))
+        ids = self.get_ranked_ids(stop)[start:stop:step]
+        products = Product.objects.in_bulk(ids)
+        # Skip products deleted since the ranking was cached
+        return [products[product_id] for product_id in ids if product_id in products]
@@ -0,0 +1,279 @@
+import hashlib
+import re
+import zlib
+from decimal import Decimal
+
+from django.core import signing
+from django.core.cache import caches
+from django.db import connection, transaction
+from django.db.models import F, FloatField, Q, Value
+from django.db.models.expressions import RawSQL
+
+from .models import Product, SharedCounter, get_product_tags
+from .recommender import tag_matrix
+
+# SQLite FTS5 table holding the searchable text of every product, with the product id as rowid
+search_table = 'store_productsearch'
+# BM25 weights of the name, description, tags and seller columns of the search table
+column_weights = (10.0, 1.0, 5.0, 3.0)
+# Orderings of search results, selected by the 'sort' query parameter, as the ordering key and
+# whether it is descending. Ties are broken by ascending id
+search_orderings = {
+    'relevance': ('search_rank', False),
+    'rating': ('rating', True),
+    'name': ('name', False),
+    'price_asc': ('price', False),
+    'price_desc': ('price', True),
+}
+# Salt of the signed cursors of search result pages
+cursor_salt = 'store.search.cursor'
+# Longest query term or tag fragment tracked on its own for invalidating cached results.
+# Longer ones are tracked by their first 'max_tracked_length' characters, so that a change
+# to a product only bumps a few generations per word
+max_tracked_length = 3
+# Number of shared generation counters of each kind (words and tags) that tracked fragments
+# are hashed into, which bounds the counters whatever the catalog's vocabulary
+generation_buckets = 4096
+
+# Product ids of recently shown search result pages
+search_cache = caches['search']
+
+def get_search_terms(query):
+    '''
+    Split a search query into lowercase words
+    '''
+
+    return re.findall(r'\w+', query.lower())
+
+def search_products(queryset, query):
+    '''
+    Filter a queryset of products to those matching every word of the query (each word also
+    matches longer words it is the start of), annotated with their BM25 score as search_rank
+    (lower is a better match)
+    - The search table is joined on the product id, so matching, ranking and any further
+      filtering, ordering and slicing all happen in one SQL query
+    '''
+
+    terms = get_search_terms(query)
+    if not terms:
+        return queryset.none()
+
+    match = ' '.join(f'"{term}"*' for term in terms)
+    weights = ', '.join(str(weight) for weight in column_weights)
+    return queryset.extra(tables=[search_table],
+                          where=[f'{search_table}.rowid = {Product._meta.db_table}.id', f'{search_table} MATCH %s'],
+                          params=[match]) \
+                   .annotate(search_rank=RawSQL(f'bm25({search_table}, {weights})', (), output_field=FloatField())) \
+                   .order_by('search_rank', 'id')
+
+def search_tags(query):
+    '''
+    Return the ids of the products whose tags match a comma separated tag query, in ascending order
+    - Every comma separated term must match (AND), and a term may list alternatives separated
+      by '|' of which any one has to match (OR)
+    - A term matches every tag whose name contains it, ignoring case. As terms match parts of
+      tag names, each term is checked against every tag name rather than looked up
+    - The product ids of the matching tags come from the recommender's tag matrix (an inverted
+      index of tag -> product ids), which is patched when tags change in this process and only
+      read from the database again after they change in another (see TagMatrix.update_products)
+    '''
+
+    columns, _ = tag_matrix.get()
+    product_ids = None
+    for term in query.split(','):
+        alternatives = [alternative.strip().lower() for alternative in term.split('|') if alternative.strip()]
+        if not alternatives:
+            continue
+
+        matched = set()
+        for tag, tag_product_ids in columns.items():
+            if any(alternative in tag.lower() for alternative in alternatives):
+                matched.update(tag_product_ids)
+        product_ids = matched if product_ids is None else product_ids & matched
+        if not product_ids:
+            break
+
+    return sorted(product_ids or ())
+
+def search_products_by_tags(queryset, query):
+    '''
+    Filter a queryset of products to those whose tags match a tag query (see search_tags),
+    annotated with a search_rank of 0 so that they are ranked by id
+    '''
+
+    return queryset.filter(id__in=search_tags(query)) \
+                   .annotate(search_rank=Value(0.0, output_field=FloatField())) \
+                   .order_by('search_rank', 'id')
+
+def get_search_page(queryset, sort, cursor, page_size):
+    '''
+    Return a page of search results and the cursor of the next page, or None on the last page
+    - queryset must be annotated with a search_rank, as by search_products or search_products_by_tags.
+      See search_orderings for the values of sort
+    - Pages are found from the sort key and id of the last product of the previous page (keyset
+      pagination), so deep pages are as cheap as the first and stay stable as products change.
+      A missing or invalid cursor returns the first page
+    - Every page is one query: the relevance rank comes from the join to the full text index and
+      the rating from the stored review totals. The matching products are then sorted, as no index
+      can give them in order once the full text index or a list of ids picks them
+    '''
+
+    if queryset.query.is_empty():
+        return [], None
+    if sort not in search_orderings:
+        sort = 'relevance'
+    key, descending = search_orderings[sort]
+
+    queryset = queryset.annotate(rating=Product.avg_rating_expression()) \
+                       .order_by(F(key).desc() if descending else F(key).asc(), 'id')
+
+    try:
+        cursor_sort, value, last_id = signing.loads(cursor, salt=cursor_salt) if cursor else (None, None, None)
+    except (signing.BadSignature, ValueError, TypeError):
+        cursor_sort = None
+    if cursor_sort == sort:
+        after = Q(**{f'{key}__lt' if descending else f'{key}__gt': value}) | Q(**{key: value, 'id__gt': last_id})
+        queryset = queryset.filter(after)
+
+    products = list(queryset[:page_size + 1])
+    if len(products) <= page_size:
+        return products, None
+
+    products = products[:page_size]
+    value = getattr(products[-1], key)
+    if isinstance(value, Decimal):
+        value = str(value)
+    return products, signing.dumps((sort, value, products[-1].id), salt=cursor_salt)
+
+def index_products(product_ids):
+    '''
+    Update the search table rows of the given products, removing those of deleted products,
+    and invalidate the cached searches matching their old or new text
+    '''
+
+    product_ids = set(product_ids)
+    if not product_ids:
+        return
+
+    product_tags = get_product_tags(product_ids)
+    rows = [(product_id, name, description, ', '.join(product_tags.get(product_id, [])), seller or '')
+            for product_id, name, description, seller
+            in Product.objects.filter(id__in=product_ids).values_list('id', 'name', 'description', 'seller__nickname')]
+    with transaction.atomic(), connection.cursor() as cursor:
+        old_rows = get_search_rows(product_ids)
+        cursor.executemany(f'DELETE FROM {search_table} WHERE rowid = %s', [(product_id,) for product_id in product_ids])
+        cursor.executemany(f'INSERT INTO {search_table} (rowid, name, description, tags, seller) VALUES (%s, %s, %s, %s, %s)', rows)
+        invalidate_rows(old_rows + rows)
+
+def rebuild_search_index():
+    '''
+    Rebuild the search table from every product
+
+    Returns the number of products indexed
+    '''
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        # Rows of deleted products are dropped by the rebuild, so invalidate the searches they matched first
+        cursor.execute(f'SELECT rowid, name, description, tags, seller FROM {search_table}')
+        invalidate_rows(cursor.fetchall())
+        cursor.execute(f'DELETE FROM {search_table}')
+        product_ids = list(Product.objects.values_list('id', flat=True))
+        index_products(product_ids)
+    return len(product_ids)
+
+def get_search_rows(product_ids):
+    '''
+    Return the search table rows of the given products as (id, name, description, tags, seller) tuples
+    '''
+
+    product_ids = list(product_ids)
+    with connection.cursor() as cursor:
+        cursor.execute(f'SELECT rowid, name, description, tags, seller FROM {search_table} '
+                       f'WHERE rowid IN ({", ".join(["%s"] * len(product_ids))})', product_ids)
+        return cursor.fetchall()
+
+def get_generation_key(kind, text):
+    '''
+    Return the name of the shared counter holding the generation of the cached searches for
+    a word or tag fragment - fragments sharing their first max_tracked_length characters, or
+    whose hash falls in the same bucket, share a generation
+    '''
+
+    bucket = zlib.crc32(text[:max_tracked_length].encode()) % generation_buckets
+    return f'search:{kind}:{bucket}'
+
+def get_query_key(query):
+    '''
+    Return a search query in normal form, and the generation keys of the cached results it depends on
+    - A plain query depends on the words starting with each of its terms, and a tag query (see
+      search_tags) on the tags containing each of its alternatives
+    - Queries with the same normal form have the same results, whatever their case, spacing,
+      or the order of their terms
+    '''
+
+    if query.find(",") != -1 or query.find("|") != -1:
+        terms = sorted({'|'.join(sorted({alternative.strip().lower() for alternative in term.split('|') if alternative.strip()}))
+                        for term in query.split(',')} - {''})
+        keys = {get_generation_key('tag', alternative) for term in terms for alternative in term.split('|')}
+        return 'tags:' + ','.join(terms), keys
+
+    terms = sorted(set(get_search_terms(query)))
+    keys = {get_generation_key('word', term) for term in terms}
+    return 'words:' + ' '.join(terms), keys
+
+def invalidate_rows(rows):
+    '''
+    Invalidate the cached results of every search that may match the given search table rows,
+    in every process, once the current transaction commits
+    - Tags are stored in the rows separated by ', ', which tag names can't contain
+    '''
+
+    words = set()
+    fragments = set()
+    for _, name, description, tags, seller in rows:
+        for word in get_search_terms(' '.join((name, description, tags, seller))):
+            words.update(word[:length] for length in range(1, min(len(word), max_tracked_length) + 1))
+        for tag in tags.lower().split(', '):
+            fragments.update(tag[start:end] for start in range(len(tag))
+                             for end in range(start + 1, min(len(tag), start + max_tracked_length) + 1))
+    keys = {get_generation_key('word', word) for word in words} | {get_generation_key('tag', fragment) for fragment in fragments}
+    if keys:
+        transaction.on_commit(lambda: SharedCounter.increment(dict.fromkeys(keys, 1)))
+
+def invalidate_search_results(product_ids):
+    '''
+    Invalidate the cached results of every search matching the given products, after a change
+    to their stock, listing status or any of the fields the search page filters on
+    '''
+
+    product_ids = set(product_ids)
+    if product_ids:
+        invalidate_rows(get_search_rows(product_ids))
+
+def get_result_page(query, filter_params, sort, cursor, page_size, find_page):
+    '''
+    Return a page of search results and the cursor of the next page, from the search cache when possible
+    - filter_params is a dict of the search's ProductFilter parameters, and sort, cursor and
+      page_size are as for get_search_page
+    - find_page is called to find the page when it isn't cached, and returns the products and
+      the next cursor like get_search_page
+    - Pages are cached as the ids of their products. They are dropped when they expire, or as soon
+      as a product matching the query before or after a change is changed in any process, as the
+      generations of the query's words or tags are shared counters (see invalidate_rows)
+    '''
+
+    normal_query, generation_keys = get_query_key(query)
+    key = 'search:page:' + hashlib.sha1(repr((normal_query, sorted(filter_params.items()), sort, cursor, page_size))
+                                        .encode()).hexdigest()
+
+    # Read the generations before finding the page, so that a change made meanwhile invalidates it
+    generations = SharedCounter.get_values(generation_keys)
+    cached = search_cache.get(key)
+    if cached is not None and cached[0] == generations:
+        _, ids, next_cursor = cached
+        products = Product.objects.filter(id__in=ids, remaining_unit__gt=0, is_active=True).in_bulk()
+        return [products[product_id] for product_id in ids if product_id in products], next_cursor
+
+    products, next_cursor = find_page()
+    search_cache.set(key, (generations, [product.id for product in products], next_cursor))
+    return products, next_cursor
@@ -0,0 +1,171 @@
+'''
+Signal handlers that keep derived data (eg. recommender indexes) in sync with the models
+'''
+
+from django.db.models.signals import m2m_changed, post_delete, post_init, post_save, pre_delete
+from django.dispatch import receiver
+from taggit.models import TaggedItem
+
+from .auctions import reschedule_auctions
+from .autocomplete import autocomplete
+from .models import Customer, CustomerProfile, Product, ProductNeighbor, ProductReview
+from .recommender import recommendation_cache, refresh_neighbors, tag_matrix
+from .search import index_products, invalidate_search_results
+
+# Product fields held in the search index
+searched_fields = ('name', 'description', 'seller_id')
+# Product fields held in the autocomplete index other than its sold units, or deciding whether a product is in it
+suggested_fields = ('name', 'seller_id', 'is_active')
+# Product fields deciding whether a product is found by a search with the search page's filters
+filtered_fields = ('is_active', 'price', 'selling_type', 'isAnimal')
+
+def get_filtered_state(product):
+    '''
+    Return the values deciding whether a product passes the search page's filters
+    '''
+
+    remaining_unit = product.__dict__.get('remaining_unit')
+    return tuple(product.__dict__.get(field) for field in filtered_fields) + (remaining_unit is not None and remaining_unit > 0,)
+
+def get_suggested_state(product):
+    '''
+    Return the values the autocomplete index holds for a product, other than its sold units
+    '''
+
+    remaining_unit = product.__dict__.get('remaining_unit')
+    return tuple(product.__dict__.get(field) for field in suggested_fields) + (remaining_unit is not None and remaining_unit > 0,)
+
+def is_recommendable(product):
+    '''
+    Return whether a product is one the recommender can suggest, or None if its
+    stock or listing status was not loaded
+    '''
+
+    if 'remaining_unit' not in product.__dict__ or 'is_active' not in product.__dict__:
+        return None
+    return product.remaining_unit is not None and product.remaining_unit > 0 and product.is_active
+
+@receiver(m2m_changed, sender=TaggedItem)
+def product_tags_changed(sender, instance, action, **kwargs):
+    '''
+    Update the recommender's tag matrix, similar items, the search index and the autocomplete
+    index whenever a product gains or loses tags
+    '''
+
+    if isinstance(instance, Product) and action in ('post_add', 'post_remove', 'post_clear'):
+        tag_matrix.update_products([instance.id])
+        recommendation_cache.invalidate_all()
+        refresh_neighbors(instance.id)
+        index_products([instance.id])
+        autocomplete.update_products([instance.id])
+
+@receiver(post_init, sender=Product)
+def remember_product_state(sender, instance, **kwargs):
+    instance._was_recommendable = is_recommendable(instance)
+    instance._was_active = instance.__dict__.get('is_active')
+    instance._saved_end_date = instance.__dict__.get('end_date')
+    instance._saved_search_fields = tuple(instance.__dict__.get(field) for field in searched_fields)
+    instance._saved_suggested_state = get_suggested_state(instance)
+    instance._saved_sold_unit = instance.__dict__.get('sold_unit')
+    instance._saved_filtered_state = get_filtered_state(instance)
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance, created, **kwargs):
+    '''
+    Drop cached recommendations when a product is listed, unlisted, sold out or restocked,
+    update similar items when it is listed or unlisted, update the search and autocomplete
+    indexes when the product's searchable text, sales or listing status changes, drop
+    the cached searches it may appear in when it changes in a way the search page filters on,
+    and have the auction scheduler reload when an auction is listed, unlisted or rescheduled
+    '''
+
+    end_date = instance.__dict__.get('end_date')
+    if instance.__dict__.get('selling_type') == 'auction' and \
+            (created or instance.is_active != instance._was_active or end_date != instance._saved_end_date):
+        reschedule_auctions()
+    instance._saved_end_date = end_date
+
+    recommendable = is_recommendable(instance)
+    if created or recommendable != instance._was_recommendable:
+        recommendation_cache.invalidate_all()
+        recommendation_cache.invalidate_guest()
+    if not created and instance.is_active != instance._was_active:
+        refresh_neighbors(instance.id)
+    instance._was_recommendable = recommendable
+    instance._was_active = instance.is_active
+
+    search_fields = tuple(instance.__dict__.get(field) for field in searched_fields)
+    if created or search_fields != instance._saved_search_fields:
+        index_products([instance.id])
+    instance._saved_search_fields = search_fields
+
+    filtered_state = get_filtered_state(instance)
+    if not created and filtered_state != instance._saved_filtered_state:
+        invalidate_search_results([instance.id])
+    instance._saved_filtered_state = filtered_state
+
+    suggested_state = get_suggested_state(instance)
+    sold_unit = instance.__dict__.get('sold_unit')
+    if created or suggested_state != instance._saved_suggested_state:
+        autocomplete.update_products([instance.id])
+    elif sold_unit != instance._saved_sold_unit:
+        autocomplete.update_sales([instance.id])
+    instance._saved_suggested_state = suggested_state
+    instance._saved_sold_unit = sold_unit
+
+@receiver(pre_delete, sender=Product)
+def remember_product_listings(sender, instance, **kwargs):
+    instance._listed_by = list(ProductNeighbor.objects.filter(neighbor=instance).values_list('product_id', flat=True))
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance, **kwargs):
+    tag_matrix.update_products([instance.id])
+    recommendation_cache.invalidate_all()
+    recommendation_cache.invalidate_guest()
+    refresh_neighbors(instance.id, instance._listed_by)
+    index_products([instance.id])
+    autocomplete.update_products([instance.id])
+
+@receiver(post_init, sender=Customer)
+def remember_customer_nickname(sender, instance, **kwargs):
+    instance._saved_nickname = instance.__dict__.get('nickname')
+
+@receiver(post_save, sender=Customer)
+def customer_saved(sender, instance, created, **kwargs):
+    '''
+    Update the search index for a seller's products and the autocomplete index when their
+    nickname changes
+    '''
+
+    if not created and instance.__dict__.get('nickname') != instance._saved_nickname:
+        index_products(Product.objects.filter(seller=instance).values_list('id', flat=True))
+        autocomplete.update_seller(instance.id, instance.nickname)
+    instance._saved_nickname = instance.__dict__.get('nickname')
+
+@receiver(post_init, sender=ProductReview)
+def remember_review_rating(sender, instance, **kwargs):
+    instance._saved_rating = instance.__dict__.get('rating')
+
+@receiver(post_save, sender=ProductReview)
+def review_saved(sender, instance, created, **kwargs):
+    '''
+    Drop cached recommendations when a review changes a product's rating
+    '''
+
+    if created or instance.rating != instance._saved_rating:
+        recommendation_cache.invalidate_all()
+        recommendation_cache.invalidate_guest()
+    instance._saved_rating = instance.rating
+
+@receiver(post_delete, sender=ProductReview)
+def review_deleted(sender, instance, **kwargs):
+    recommendation_cache.invalidate_all()
+    recommendation_cache.invalidate_guest()
+
+@receiver(post_save, sender=CustomerProfile)
+def profile_saved(sender, instance, **kwargs):
+    '''
+    Drop a customer's cached recommendations after they view or buy something
+    '''
+
+    recommendation_cache.invalidate_customer(instance.customer_id)
@@ -1,12 +1,25 @@
 from django import template
-from ..models import Customer
+from ..models import Customer, Wishlist
 
 register = template.Library()
 
-@register.simple_tag
-def check_exist_tag(customer, product):
-    if isinstance(customer, Customer):
-        wishlist = customer.wishlist
-        return customer.wishlist.check_exist(wishlist, product)
-    else:
-        return False
\ No newline at end of file
+@register.simple_tag(takes_context=True)
+def check_exist_tag(context, customer, product):
+    '''
+    Return whether the product is in the customer's wishlist
+    - The ids of the wishlisted products are loaded once per request and shared by every
+      use of the tag
+    '''
+
+    if not isinstance(customer, Customer):
+        return False
+
+    request = context.get('request')
+    if request is None:
+        return product.id in Wishlist.get_product_ids(customer)
+
+    if not hasattr(request, '_wishlist_ids'):
+        request._wishlist_ids = dict()
+    if customer.id not in request._wishlist_ids:
+        request._wishlist_ids[customer.id] = Wishlist.get_product_ids(customer)
+    return product.id in request._wishlist_ids[customer.id]
@@ -18,6 +18,7 @@ urlpatterns = [
     path('wishlist/', views.wishlist, name="wishlist"),
     path('user_profile/<slug:slug>/', views.userProfile, name="user_profile"),
     path('search_result/', views.searchResult, name="search_result"),
+    path('search_suggestions/', views.search_suggestions, name="search_suggestions"),
     path('process_order/', views.processOrder, name="process_order"),
     path('new_product/', views.new_product, name='new_product'),
     path('my_listings/', views.my_listings, name='my_listings'),
@@ -51,6 +52,7 @@ urlpatterns = [
     path('restore/', views.restore, name="restore"),
     path('webhook/', views.webhook, name="webhook"),
     path('add_bid/', views.add_bid, name="add_bid"),
+    path('watch_bids/<int:product_id>/', views.watch_bids, name="watch_bids"),
     path('add_wishlist/', views.add_wishlist, name="add_wishlist"),
     path('remove_wishlist/', views.remove_wishlist, name="remove_wishlist"),
     path(r"^messages/", include("pinax.messages.urls", namespace="pinax_messages")),
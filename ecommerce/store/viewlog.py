@@ -0,0 +1,83 @@
+import atexit
+import threading
+import traceback
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from .models import ProductViewCount
+
+# Number of buffered (customer, product) pairs that triggers an early flush
+flush_size = 200
+# Maximum number of seconds a view stays in the buffer before being written
+flush_interval = 10
+
+class ViewLog:
+    '''
+    Write-behind buffer of product views
+    - Views are merged in memory per (customer, product) pair and written by a background
+      thread in one bulk upsert, so logging a view never waits on the database
+    - Stored counts are only ever incremented by the database, so they stay exact when
+      several worker processes flush at once
+    - The buffer is flushed every 'flush_interval' seconds, as soon as it holds 'flush_size'
+      pairs, and when the process exits. Views still buffered when a process is killed are lost
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pending = dict()
+        self.worker = None
+
+    def add(self, customer_id, product_id):
+        with self.lock:
+            count, _ = self.pending.get((customer_id, product_id), (0, None))
+            self.pending[(customer_id, product_id)] = (count + 1, timezone.now())
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name='view-log', daemon=True)
+                self.worker.start()
+            if len(self.pending) >= flush_size:
+                self.wakeup.set()
+
+    def get_pending(self, customer_id):
+        '''
+        Return the last viewing time of each product viewed by the customer that has not been written yet
+        '''
+
+        with self.lock:
+            return {product_id: last_viewing for (pending_customer_id, product_id), (_, last_viewing)
+                    in self.pending.items() if pending_customer_id == customer_id}
+
+    def flush(self):
+        '''
+        Write every buffered view to the database
+        - If the write fails the views are put back in the buffer to be retried on the next flush
+        '''
+
+        with self.lock:
+            views, self.pending = self.pending, dict()
+        if not views:
+            return
+
+        try:
+            ProductViewCount.save_views([(customer_id, product_id, count, last_viewing)
+                                         for (customer_id, product_id), (count, last_viewing) in views.items()])
+        except Exception:
+            with self.lock:
+                for key, (count, last_viewing) in views.items():
+                    pending_count, pending_last_viewing = self.pending.get(key, (0, last_viewing))
+                    self.pending[key] = (count + pending_count, max(last_viewing, pending_last_viewing))
+            raise
+
+    def run(self):
+        while True:
+            self.wakeup.wait(flush_interval)
+            self.wakeup.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                traceback.print_exc()
+
+view_log = ViewLog()
+atexit.register(view_log.flush)
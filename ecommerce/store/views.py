@@ -14,6 +14,7 @@ from django.core.mail import EmailMessage
 from django.conf import settings
 from django.template.loader import render_to_string
 from django.http import JsonResponse
+from asgiref.sync import sync_to_async
 from django.http import HttpResponse, HttpResponseNotFound, HttpResponseForbidden
 from django.views.decorators.http import require_http_methods
 import os
@@ -22,7 +23,7 @@ import json
 import datetime
 import base64
 import re
-import threading
+from decimal import Decimal, InvalidOperation
 from uuid import uuid4
 
 from django.views.decorators.csrf import csrf_exempt
@@ -33,9 +34,15 @@ from django.views.generic import TemplateView, ListView
 from django.db.models import Q
 from django.core.paginator import Paginator
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import transaction
 
 from .forms import OrderForm, CreateUserForm, UpdateUserForm, UpdateUserProfilePic, EditProductForm, NewReviewForm
-from .recommender import Recommender
+from .recommender import Recommender, recommendation_cache
+from .viewlog import view_log
+from .search import get_result_page, get_search_page, invalidate_search_results, search_products, search_products_by_tags
+from .autocomplete import autocomplete
+from .cart import invalidate_cart_summary
+from .live import bid_updates, get_bid_state, watch_timeout
 
 ### Constants ###
 
@@ -47,6 +54,13 @@ max_recent = 10
 paginated_size = 9
 # Number of recent orders to display under each product on manage listings page
 recent_orders_display_size = 5
+# Orderings of product page reviews, selected by the 'review_sort' query parameter
+review_orderings = {
+    'top': ('-score', '-date_posted'),
+    'recent': ('-date_posted',),
+    'rating_desc': ('-rating', '-date_posted'),
+    'rating_asc': ('rating', '-date_posted'),
+}
 
 #################
 
@@ -64,28 +78,28 @@ def store(request):
     if request.user.is_authenticated:
         customer = request.user.customer
         ca = customer
-        cartItems = cart_items(customer)
         
 
         # Get most recently viewed products - this displays even unlisted items
-        view_counts = ProductViewCount.objects.filter(customer=request.user.customer).order_by('-last_viewing')
-        recent_products = [view_count.product for view_count in view_counts][:max_recent]
+        # Views still waiting in the view log are included so the list is up to date
+        last_viewings = dict(ProductViewCount.objects.filter(customer=customer, product__isnull=False)
+                                                     .order_by('-last_viewing')
+                                                     .values_list('product_id', 'last_viewing')[:max_recent])
+        for product_id, last_viewing in view_log.get_pending(customer.id).items():
+            last_viewings[product_id] = max(last_viewing, last_viewings.get(product_id, last_viewing))
+        recent_ids = sorted(last_viewings, key=last_viewings.get, reverse=True)[:max_recent]
+        recent_by_id = Product.objects.in_bulk(recent_ids)
+        recent_products = [recent_by_id[product_id] for product_id in recent_ids if product_id in recent_by_id]
 
         context['customer'] = customer
     else:
-        cartItems = 0
         recent_products = []
 
-    # Get products from recommender
+    # Get the requested page of products from recommender
     rec = Recommender(customer=request.user.customer if request.user.is_authenticated else None)
-    products = rec.get_recommended_products()
-    
-    # Paginate product list
-    paginator = Paginator(products, paginated_size)
-    page_number = request.GET.get('page')
-    paginated_products = paginator.get_page(page_number)
+    paginated_products = rec.get_recommended_page(request.GET.get('page'), paginated_size)
 
-    context.update({'products':paginated_products, 'recent': recent_products, 'cartItems':cartItems})
+    context.update({'products':paginated_products, 'recent': recent_products})
     return render(request, 'store/store.html', context)
 
 def signup(request):
@@ -131,8 +145,7 @@ def signup(request):
                     [user.email],
                 )
 
-                email.fail_silently = False
-                email.send()
+                OutgoingEmail.enqueue([email])
 
                 return redirect('signup_success')
 
@@ -207,7 +220,6 @@ def product_page(request, slug=None):
 
     if request.user.is_authenticated:
         customer = request.user.customer
-        cartItems = cart_items(customer)
         is_owner = customer == product.seller
         ProductViewCount.log(customer, product)
         try:
@@ -215,47 +227,44 @@ def product_page(request, slug=None):
         except ObjectDoesNotExist:
             user_review = None
         
-        # Get all of the user's reacts to reviews for this product
-        user_reacts = ReviewReact.objects.filter(customer=request.user.customer, review__product=product)
+        # Get all of the user's reacts to reviews for this product, as a map of review id to liked
+        user_reacts = dict(ReviewReact.objects.filter(customer=customer, review__product=product)
+                                              .values_list('review_id', 'liked'))
         context['customer'] = customer
         context['seller'] = Customer.objects.get(slug_str=product.seller.slug_str)
         
     else:
-        #Create empty cart for now for non-logged in user
-        cartItems = 0
         is_owner = False
         user_review = None
+        user_reacts = {}
 
-    similar_items = product.tags.similar_objects()[:max_similar]
-    similar_items = list(filter(lambda p: p.is_active, similar_items))
+    similar_items = ProductNeighbor.get_similar(product, max_similar)
     
+    # Customers who have completed a purchase of the product, whose reviews are verified
+    buyers = set(OrderItem.objects.filter(product=product, order__complete=True)
+                                  .values_list('order__customer_id', flat=True).distinct())
+
     # Get initial state of like and dislike buttons for each review
     reviews = []
-    for review in product.reviews.all():
-        liked = False
-        disliked = False
-        if request.user.is_authenticated:
-            try:
-                react = user_reacts.get(review=review)
-                liked = react.liked
-                disliked = not liked
-            except ObjectDoesNotExist:
-                pass
+    review_sort = request.GET.get('review_sort')
+    review_list = product.reviews.select_related('author').order_by(*review_orderings.get(review_sort, ('id',)))
+    for review in review_list:
+        react = user_reacts.get(review.id)
         reviews.append({
             "review": review,
-            "liked": liked,
-            "disliked": disliked,
-            "verified": OrderItem.objects.filter(product=product, order__customer=review.author, order__complete=True).exists()
+            "liked": react is True,
+            "disliked": react is False,
+            "verified": review.author_id in buyers
         })
 
     context.update({
         "product": product,
         "tags": product.tags.names(),
-        "cartItems": cartItems,
         "similar_items": similar_items,
         "is_owner": is_owner,
         "user_review": user_review,
-        "reviews": reviews
+        "reviews": reviews,
+        "review_sort": review_sort
     })
     return render(request, 'store/product_description.html', context)
 
@@ -271,15 +280,13 @@ def cart(request):
     if request.user.is_authenticated:
         customer = request.user.customer
         order, created = Order.objects.get_or_create(customer=customer, complete=False)
-        items = order.orderitem_set.all()
-        cartItems = order.get_cart_items
+        items = order.orderitem_set.select_related('product')
     else:
         #Create empty cart for now for non-logged in user
         items = []
         order = {'get_cart_total':0, 'get_cart_items':0}
-        cartItems = order.get('get_cart_items')
 
-    context = {'items':items, 'order':order, 'cartItems':cartItems}
+    context = {'items':items, 'order':order}
     return render(request, 'store/cart.html', context)
 
 def checkout(request):
@@ -294,15 +301,13 @@ def checkout(request):
     if request.user.is_authenticated:
         customer = request.user.customer
         order, created = Order.objects.get_or_create(customer=customer, complete=False)
-        items = order.orderitem_set.all()
-        cartItems = order.get_cart_items
+        items = order.orderitem_set.select_related('product')
     else:
         #Create empty cart for now for non-logged in user
         items = []
         order = {'get_cart_total':0, 'get_cart_items':0}
-        cartItems = order.get('get_cart_items')
 
-    context = {'items':items, 'order':order, 'cartItems':cartItems}
+    context = {'items':items, 'order':order}
     return render(request, 'store/checkout.html', context)
 
 def purchase_history(request):
@@ -318,8 +323,6 @@ def purchase_history(request):
         return redirect('login')
 
     customer = request.user.customer
-    # cartItems to update the total number of items in cart
-    cartItems = cart_items(customer)
     
     # To query the complete orders
     orders = Order.objects.filter(customer=customer, complete=True).order_by('-transaction_id')
@@ -346,7 +349,6 @@ def purchase_history(request):
 
     context = {
         'purchases': purchases,
-        'cartItems': cartItems,
         'delivered': orders.count,
         'pending': Order.objects.filter(customer=customer, complete=False).count,
         'total_orders': Order.objects.filter(customer=customer).count
@@ -367,8 +369,6 @@ def wishlist(request):
         return redirect('login')
 
     customer = request.user.customer
-    # cartItems to update the total number of items in cart
-    cartItems = cart_items(customer)
     
     # To query the complete orders
     wishlist = customer.wishlist.product.all()
@@ -390,7 +390,6 @@ def wishlist(request):
 
     context = {
         'items': items,
-        'cartItems': cartItems,
         'pending': Order.objects.filter(customer=customer, complete=False).count,
         'total_orders': Order.objects.filter(customer=customer).count
     }
@@ -424,7 +423,6 @@ def userProfile(request, slug=None):
     # order is for cart to update the total number of items in cart
     customer = request.user.customer
     customer_match = Customer.objects.get(slug_str=slug)
-    cartItems = cart_items(customer)
 
     orders = Order.objects.filter(customer=customer)
 
@@ -439,8 +437,7 @@ def userProfile(request, slug=None):
         'items': items,
         'user_form': user_form,
         'user_pic_form': user_pic_form,
-        'orders': orders,
-        'cartItems':cartItems
+        'orders': orders
         }
     return render(request, 'store/user_profile.html', context)
 
@@ -478,32 +475,47 @@ def processOrder(request):
     if request.user.is_authenticated:
         customer = request.user.customer
         order, created = Order.objects.get_or_create(customer=customer, complete=False)
-        total = float(data['form']['total'])
-        order.transaction_id = transaction_id
+        try:
+            total = Decimal(str(data['form']['total']))
+        except InvalidOperation:
+            total = None
 
         # To prevent user change the value through javascript to bypass the checkout checking
-        if total == order.get_cart_total:
+        # Prices are compared as exact decimals, rounded to the cents shown at checkout
+        if total != Decimal(order.get_cart_total).quantize(Decimal('0.01')):
+            return JsonResponse('Your cart has changed, please review your order and try again', safe=False, status=409)
+
+        orderItems = list(order.orderitem_set.filter(product__isnull=False).select_related('product__seller'))
+        quantities = dict()
+        for item in orderItems:
+            quantities[item.product_id] = quantities.get(item.product_id, 0) + item.quantity
+
+        # Take the stock of every item in one update, cancelling the whole order if any item has run out
+        with transaction.atomic():
+            if not Product.take_stock(quantities):
+                transaction.set_rollback(True)
+                return JsonResponse('Some items in your cart are out of stock', safe=False, status=409)
+
+            order.transaction_id = transaction_id
             order.complete = True
             order.date_ordered = timezone.now()
-        order.save()
-
-        ShippingAddress.objects.create(
-            customer=customer,
-            order=order,
-            recipient=customer.nickname,
-            address=data['shipping']['address'],
-            city=data['shipping']['city'],
-            state=data['shipping']['state'],
-            postcode=data['shipping']['postcode'],
-        )
+            order.save()
+
+            ShippingAddress.objects.create(
+                customer=customer,
+                order=order,
+                recipient=customer.nickname,
+                address=data['shipping']['address'],
+                city=data['shipping']['city'],
+                state=data['shipping']['state'],
+                postcode=data['shipping']['postcode'],
+            )
+
+            CustomerProfile.add_products(customer, [item.product_id for item in orderItems], purchase_weight)
 
-        orderItems =  order.orderitem_set.all()
+        emails = []
         for item in orderItems:
-            product = Product.objects.get(id=item.product.id)
-            product.remaining_unit -= item.quantity
-            product.sold_unit += item.quantity
-            product.estimated_date = timezone.now() + product.delivery_period
-            product.save()			
+            product = item.product
             if product.selling_type == "sale":
                 total_price = product.price * item.quantity
             else:
@@ -517,9 +529,7 @@ def processOrder(request):
                 settings.EMAIL_HOST_USER,
                 [product.seller.email],
             )
-
-            email.fail_silently = False
-            email.send()
+            emails.append(email)
 
             seller_template = render_to_string('store/email_processOrder_to_buyer.html', {'name': customer.nickname, 'product': product.name, 'unit': item.quantity, 'total': total_price})
 
@@ -529,9 +539,19 @@ def processOrder(request):
                 settings.EMAIL_HOST_USER,
                 [customer.email],
             )
-
-            email.fail_silently = False
-            email.send()
+            emails.append(email)
+
+        OutgoingEmail.enqueue(emails)
+        invalidate_cart_summary(customer)
+        # Stock was taken with an update, so refresh the sales and listing status no signal reported
+        # Search results, suggestions and recommendations only change for the products that sold out
+        sold_out = list(Product.objects.filter(id__in=quantities.keys(), remaining_unit=0).values_list('id', flat=True))
+        autocomplete.update_sales(quantities.keys() - set(sold_out))
+        if sold_out:
+            autocomplete.update_products(sold_out)
+            invalidate_search_results(sold_out)
+            recommendation_cache.invalidate_all()
+            recommendation_cache.invalidate_guest()
 
     return JsonResponse('Payment success', safe=False)
 
@@ -562,40 +582,59 @@ def new_product(request):
                 'price': 10.00,
                 'isAnimal': False
             })
-        customer = request.user.customer
-        cartItems = cart_items(customer)
 
-        context = {"form": form, 'cartItems':cartItems}
+        context = {"form": form}
         return render(request, 'store/new_product.html', context)
   
 def searchResult(request):
     '''
     Path: 'search_result/', GET request
 
-    Process a search query and render the search page with results
+    Process a search query and render the search page with a page of results
+    - Results are sorted by the 'sort' query parameter (see search_orderings), and the
+      'after' query parameter holds the cursor of the page to show
+    - Pages are read straight from the search query joined to the full text index (see get_search_page),
+      and the ids of their products are cached for each query, set of filters and sort (see get_result_page)
 
     Return a rendered HTML template as a HTTPResponse
     '''
     context = {}
     if request.user.is_authenticated:
         customer = request.user.customer
-        cartItems = cart_items(customer)
         context['customer'] = customer
-    else:
-        cartItems = 0
 
     query = request.GET.get('q')
     if query is None:
         query = request.GET.get('cached_q')
-    product_list = query_result(query)
-
-    advancedFilter = ProductFilter(request.GET, queryset=product_list)
-    product_list = advancedFilter.qs
-
-    context.update({'product_list':product_list, 'cartItems':cartItems,'myFilter':advancedFilter, 'query':query})
+    advancedFilter = ProductFilter(request.GET, queryset=Product.objects.filter(remaining_unit__gt=0, is_active=True))
+    sort = request.GET.get('sort')
+    after = request.GET.get('after')
+    filter_params = {name: request.GET.get(name, '') for name in ProductFilter.base_filters}
+    find_page = lambda: get_search_page(ProductFilter(request.GET, queryset=query_result(query)).qs, sort, after, paginated_size)
+    product_list, next_cursor = get_result_page(query, filter_params, sort, after, paginated_size, find_page) if query else ([], None)
+
+    # Query string of the current search without its sort and page, for the sort and page links
+    search_params = request.GET.copy()
+    search_params.pop('sort', None)
+    search_params.pop('after', None)
+
+    context.update({'product_list':product_list, 'myFilter':advancedFilter, 'query':query, 'sort':sort,
+                    'next_cursor':next_cursor, 'is_first_page':not request.GET.get('after'),
+                    'search_params':search_params.urlencode()})
     return render(request, 'store/product_list.html', context)
     # return product_list
 
+def search_suggestions(request):
+    '''
+    Path: 'search_suggestions/', GET request
+
+    Suggest the tags, product names and sellers with a word starting with the 'q' query
+    parameter, best selling first. Suggestions are answered from an in-memory index (see autocomplete.py)
+
+    Returns a JSONResponse object
+    '''
+    return JsonResponse(data={'suggestions': autocomplete.suggest(request.GET.get('q', ''))})
+
 def add_multiple(request):
     '''
     Path: 'add_multiple/', POST request, requires login
@@ -627,6 +666,7 @@ def add_multiple(request):
 
         if orderItem.quantity <= 0:
             orderItem.delete()
+        invalidate_cart_summary(customer)
 
     return JsonResponse('added', safe=False)
 
@@ -651,14 +691,21 @@ def restore(request):
     for item in order_items:
         if item.product.id == productId and item.id == itemId:
     
-            try:
-                product = Product.objects.get(id=productId)
-                product.remaining_unit += item.quantity
-                product.sold_unit -= item.quantity
-                product.save()
+            with transaction.atomic():
+                was_sold_out = Product.return_stock(productId, item.quantity)
+                if was_sold_out is None:
+                    print('none')
+                    break
                 item.delete()
-            except Product.DoesNotExist:
-                print('none')
+                CustomerProfile.add_products(customer, [productId], -purchase_weight)
+            invalidate_cart_summary(customer)
+            # Stock was returned with an update, so refresh the sales and listing status no signal reported
+            autocomplete.update_sales([productId])
+            if was_sold_out:
+                autocomplete.update_products([productId])
+                invalidate_search_results([productId])
+                recommendation_cache.invalidate_all()
+                recommendation_cache.invalidate_guest()
             break
 
     return JsonResponse('Cancelled', safe=False)
@@ -675,9 +722,7 @@ def my_listings(request):
     if not request.user.is_authenticated:
         return redirect('login')
 
-    # order is for cart to update the total number of items in cart
     customer = request.user.customer
-    cartItems = cart_items(customer)
 
     products = Product.objects.filter(seller=customer)
     items = []
@@ -691,7 +736,7 @@ def my_listings(request):
         })
 
 
-    context = {'items': items, 'cartItems':cartItems}
+    context = {'items': items}
     return render(request, 'store/my_listings.html', context)
 
 def view_orders(request, slug=None):
@@ -715,11 +760,9 @@ def view_orders(request, slug=None):
     paginator = Paginator(order_items, 100)
     page_number = request.GET.get('page')
     paginated_order_items = paginator.get_page(page_number)
-    cartItems = cart_items(request.user.customer)
     context = {
         'product': product,
-        'order_items': paginated_order_items,
-        'cartItems': cartItems
+        'order_items': paginated_order_items
     }
     return render(request, 'store/view_orders.html', context)
 
@@ -747,18 +790,15 @@ def edit_listing(request, slug=None):
         form = EditProductForm(request.POST)
         if form.is_valid():
             # Update field in product that was not left blank on form
-            if form.cleaned_data['name']:
-                product.name = form.cleaned_data['name']
-            if form.cleaned_data['price']:
-                product.price = form.cleaned_data['price']
-            if form.cleaned_data['remaining_unit']:
-                product.remaining_unit = form.cleaned_data['remaining_unit']
-            if form.cleaned_data['description']:
-                product.description = form.cleaned_data['description']
+            updated_fields = [field for field in ('name', 'price', 'remaining_unit', 'description') if form.cleaned_data[field]]
+            for field in updated_fields:
+                setattr(product, field, form.cleaned_data[field])
             if form.cleaned_data['tags'] or form.cleaned_data['clear_existing_tags']:
                 product.tags.set(*form.cleaned_data['tags'], clear=form.cleaned_data['clear_existing_tags'])
 
-            product.save()
+            # Only write the edited fields, so that bids placed since the product was loaded are kept
+            if updated_fields:
+                product.save(update_fields=updated_fields)
             return redirect('my_listings')
     else:
         form = EditProductForm()
@@ -770,11 +810,9 @@ def edit_listing(request, slug=None):
         form.fields['tags'].widget.attrs['placeholder'] = ', '.join(product.tags.names())
 
 
-    cartItems = cart_items(request.user.customer)
     context = {
         'form': form,
-        'product': product,
-        'cartItems':cartItems
+        'product': product
     }
     return render(request, 'store/edit_listing.html', context)
 
@@ -798,7 +836,8 @@ def toggle_unlist(request):
         return JsonResponse(data={}, status=403)
     
     product.is_active = not product.is_active
-    product.save()
+    # Only write is_active, so that bids placed since the product was loaded are kept
+    product.save(update_fields=['is_active'])
     
     return JsonResponse(data={}, status=200)
 
@@ -931,15 +970,14 @@ def webhook(request):
                     message = "You cannot place a bid to your own product!"
 
                 else:
-                    product.starting_bid = bid_price
-                    all_customer = Customer.objects.all()
-                    for customer in all_customer:
-                        if customer.nickname == customer_name:
-                            product.highest_bidder = customer
-                            product.bidder.create(name=customer_name, price=bid_price)
-                            break
-                    message = 'You have successfully placed a bid!'
-                    product.save()
+                    customer = Customer.objects.filter(nickname=customer_name).first()
+                    if customer is None:
+                        message = "We couldn't find your account!"
+                    elif Product.place_bid(product.id, customer, bid_price):
+                        bid_updates.publish(product.id, get_bid_state(product.id))
+                        message = 'You have successfully placed a bid!'
+                    else:
+                        message = f"Your bid price is not greater than the current highest bid price: ${product.starting_bid}!"
                     
             else:
                 message = f"Your bid price is not greater than the current highest bid price: ${product.starting_bid}!"
@@ -981,18 +1019,6 @@ def inquiry_product (parameters):
     
     return product
 
-def cart_items (customer):
-    '''
-    Helper Function to retrieve number of items in cart so that the cart icon number get to update
-    
-    Returns a dict
-    '''
-    order, created = Order.objects.get_or_create(customer=customer, complete=False)
-    items = order.orderitem_set.all()
-    items = order.get_cart_items
-    
-    return items
-
 def add_bid(request):
     '''
     Path: 'add_bid/', POST request, requires login
@@ -1005,14 +1031,9 @@ def add_bid(request):
     data = json.loads(request.body)
     if request.user.is_authenticated:
         customer = request.user.customer
-        order, created = Order.objects.get_or_create(customer=customer, complete=False)
-        all_customer = Customer.objects.all()
         productId = int(data['productId'])
         new_bid = int(data['new_bid'])
-        for each_customer in all_customer:
-            if each_customer.nickname == data['highest_bidder']:
-                highest_bidder = each_customer
-                
+
         try:
             product = Product.objects.get(id=productId)
         except ObjectDoesNotExist:
@@ -1024,64 +1045,54 @@ def add_bid(request):
             if customer == product.seller:
                 messages.error(request, f'You cannot place a bid to your own product!')
                 return JsonResponse('The bid must be greater than the current bid!', safe=False)
-            else:
-                product.starting_bid = new_bid
-                product.highest_bidder = highest_bidder
-                product.bidder.create(name=highest_bidder.nickname, price=new_bid)
+            elif Product.place_bid(product.id, customer, new_bid):
+                bid_updates.publish(product.id, get_bid_state(product.id))
                 messages.success(request, f'You have successfully placed a bid!')
-                product.save()
                 return JsonResponse('You have successfully placed a bid!', safe=False)
+            else:
+                # Another bid was placed first, or the auction ended in the meantime
+                messages.error(request, f'The bid must be greater than the current bid!')
+                return JsonResponse('The bid must be greater than the current bid!', safe=False)
         else:
             messages.error(request, f'The bid must be greater than the current bid!')
             return JsonResponse('The bid must be greater than the current bid!', safe=False)
 
-def check_auction_time():
+async def watch_bids(request, product_id):
     '''
-    Periodically check whether any auctions have ended, and if so,
-    process the purchase by the highest bidder
+    Path: 'watch_bids/<product_id>/', GET request
+
+    Long poll for changes to an auction's bids. The 'bids' query parameter is the number of bids
+    the page already shows - the response is sent as soon as the auction has a different number
+    of bids or has ended, or after a timeout with the unchanged state
+
+    Returns a JSONResponse object with the auction's bidding state
     '''
 
-    threading.Timer(15.0, check_auction_time).start()
-    products = Product.objects.all()
-    for product in products:
-        if product.is_active == True:
-            if product.selling_type == "auction":
-                if datetime.datetime.utcnow() >= product.end_date.replace(tzinfo=None):
-                    print("datetime_now: " + str(datetime.datetime.now()))
-                    print("end_date: " + str(product.end_date.replace(tzinfo=None)))
-                    bidder = product.highest_bidder
-                    order, created = Order.objects.get_or_create(customer=bidder, complete=False)
-
-                    orderItem, created = OrderItem.objects.get_or_create(order=order, product=product)
-                    orderItem.quantity += 1
-                    orderItem.save()
-
-                    product.is_active = False
-                    product.save()
-                    seller_template = render_to_string('store/email_auctionEnd_to_buyer.html', {'name': product.highest_bidder.nickname, 'product': product.name, 'price': product.starting_bid})
-
-                    email = EmailMessage(
-                        'You have win the Auction!',
-                        seller_template,
-                        settings.EMAIL_HOST_USER,
-                        [product.highest_bidder.email],
-                    )
-
-                    email.fail_silently = False
-                    email.send()
-
-                    seller_template = render_to_string('store/email_auctionEnd_to_seller.html', {'name': product.seller.nickname, 'product': product.name, 'bidder': product.highest_bidder.nickname, 'price': product.starting_bid})
-
-                    print(settings.EMAIL_HOST_USER)
-                    email = EmailMessage(
-                        'Your auction has ended!',
-                        seller_template,
-                        settings.EMAIL_HOST_USER,
-                        [product.seller.email],
-                    )
-
-                    email.fail_silently = False
-                    email.send()
+    if not bid_updates.enter():
+        response = JsonResponse(data={}, status=503)
+        response['Retry-After'] = str(watch_timeout)
+        return response
+
+    try:
+        try:
+            known_bids = int(request.GET.get('bids', -1))
+        except ValueError:
+            known_bids = -1
+
+        # Subscribe before reading the state, so that a bid placed in between is not missed
+        waiter = bid_updates.subscribe(product_id)
+        try:
+            state = await sync_to_async(get_bid_state)(product_id)
+            if state is None:
+                return JsonResponse(data={}, status=404)
+            if state['is_active'] and state['bidder_count'] == known_bids:
+                state = await bid_updates.wait(waiter, watch_timeout) or state
+        finally:
+            bid_updates.unsubscribe(product_id, waiter)
+    finally:
+        bid_updates.leave()
+
+    return JsonResponse(data=state, status=200)
 
 def post_new_review(request):
     '''
@@ -1110,10 +1121,13 @@ def post_new_review(request):
             rating=form.cleaned_data['rating'],
             text=form.cleaned_data['text']
         )
-        review.save()
-        # User automatically likes their own review
-        self_react = ReviewReact(liked=True,review=review, customer=request.user.customer)
-        self_react.save()
+        with transaction.atomic():
+            review.save()
+            Product.update_rating(review.product_id, review.rating, 1)
+            # User automatically likes their own review
+            self_react = ReviewReact(liked=True,review=review, customer=request.user.customer)
+            self_react.save()
+            ProductReview.update_reacts(review.id, 1, 0)
 
         return JsonResponse(data={}, status=200)
 
@@ -1141,7 +1155,9 @@ def delete_review(request):
     except ObjectDoesNotExist:
         return JsonResponse(data={}, status=400)
     
-    review.delete()
+    with transaction.atomic():
+        review.delete()
+        Product.update_rating(review.product_id, -review.rating, -1)
     return JsonResponse(data={}, status=200)
 
 def edit_review(request):
@@ -1166,10 +1182,14 @@ def edit_review(request):
         except ObjectDoesNotExist:
             return JsonResponse(data={}, status=400)
         
+        old_rating = review.rating
         review.text = form.cleaned_data['text']
         review.rating = form.cleaned_data['rating']
         review.edited = True
-        review.save()
+        with transaction.atomic():
+            # Only write the edited fields, so that reacts counted since the review was loaded are kept
+            review.save(update_fields=['text', 'rating', 'edited'])
+            Product.update_rating(review.product_id, review.rating - old_rating)
 
         return JsonResponse(data={}, status=200)
     
@@ -1202,26 +1222,31 @@ def toggle_review_react(request):
         react = None
 
     is_like = request.POST.get('is_like') == 'true'
-    if (react is None):
-        react = ReviewReact(
-            review=review,
-            customer=request.user.customer,
-            liked=is_like
-        )
-        react.save()
-        state = 'liked' if is_like else 'disliked'
+    with transaction.atomic():
+        if (react is None):
+            react = ReviewReact(
+                review=review,
+                customer=request.user.customer,
+                liked=is_like
+            )
+            react.save()
+            state = 'liked' if is_like else 'disliked'
+            ProductReview.update_reacts(review.id, int(is_like), int(not is_like))
 
-    else:
-        # Case where cancelling reaction
-        if is_like == react.liked:
-            react.delete()
-            state = 'neither'
-        # Case where switching reaction
         else:
-            react.liked = not react.liked
-            state = 'liked' if react.liked else 'disliked'
-            react.save()
-    
+            # Case where cancelling reaction
+            if is_like == react.liked:
+                react.delete()
+                state = 'neither'
+                ProductReview.update_reacts(review.id, -int(is_like), -int(not is_like))
+            # Case where switching reaction
+            else:
+                react.liked = not react.liked
+                state = 'liked' if react.liked else 'disliked'
+                react.save()
+                ProductReview.update_reacts(review.id, 1 if react.liked else -1, -1 if react.liked else 1)
+
+    review.refresh_from_db(fields=['score'])
     return JsonResponse(data={'score':review.score, 'state':state}, status=200)
 
 def add_wishlist(request):
@@ -1248,16 +1273,15 @@ def add_wishlist(request):
         if not product.is_active:
             return JsonResponse('Product is unlisted', safe=False)
 
-        for wish_item in wishlist.product.all():
-            if product == wish_item:
-                wishlist.product.remove(product)
-                wishlist.save()
-                print("Removing product_id: " + str(productId))
-                print("Removing product name:" + product.name)
-                if product.selling_type == "sale":
-                    return JsonResponse('You have remove a product in your wishlist!', safe=False)
-                else:
-                    return JsonResponse('You have remove a product in your watchlist!', safe=False)
+        if Wishlist.check_exist(wishlist, product):
+            wishlist.product.remove(product)
+            wishlist.save()
+            print("Removing product_id: " + str(productId))
+            print("Removing product name:" + product.name)
+            if product.selling_type == "sale":
+                return JsonResponse('You have remove a product in your wishlist!', safe=False)
+            else:
+                return JsonResponse('You have remove a product in your watchlist!', safe=False)
 
         print("Adding product_id: " + str(productId))
         print("Adding product name:" + product.name)
@@ -1303,46 +1327,27 @@ def remove_wishlist(request):
 def query_result (query):
     '''
     Helper Function for searchResult 
-    This will query the matched results based on product name, tag and seller
+    This will query the matched results based on product name, description, tag and seller
     
     Returns a list
     '''
-    if query == "":
+    if not query:
         product_list = Product.objects.none()
     else:
         
-        if query.find(",") != -1:
-            taglist = query.split(',')
-
-            if len(taglist) == 1:
-                product_list = Product.objects.filter(Q(tags__name__icontains=taglist[0]))
-            else:
-
-                tmp1 = Product.objects.none()
-                tmp2 = Product.objects.none()
-                counter = 0
-                for tag in taglist:
-                    tag_checked = tag
-                    if tag_checked[0] == " ":
-                        tag_checked = tag[1:]
-
-                    if counter == 0:
-                        tmp2 = Product.objects.filter(Q(tags__name__icontains=tag_checked))
-                        counter = 1
-
-                    else:
-                        tmp1 = Product.objects.filter(Q(tags__name__icontains=tag_checked))
-
-                        product_list = tmp1 & tmp2
-
-                        tmp2 = product_list
+        if query.find(",") != -1 or query.find("|") != -1:
+            # Match the products having every comma separated tag, or any of the '|' separated ones
+            # Only show products that still have units left and aren't unlisted
+            product_list = Product.objects.filter(remaining_unit__gt=0, is_active=True)
+            product_list = search_products_by_tags(product_list, query)
 
         else:
-            product_list = Product.objects.filter(Q(name__icontains=query)|Q(tags__name__icontains=query)|Q(seller__nickname__icontains=query))
+            # Search the full text index, best match first
             # Only show products that still have units left and aren't unlisted
-            product_list = product_list.filter(remaining_unit__gt=0, is_active=True).distinct()
+            product_list = Product.objects.filter(remaining_unit__gt=0, is_active=True)
+            product_list = search_products(product_list, query)
             
-        return product_list
+    return product_list
 
 def create_element (product_list):
     '''
@@ -1407,7 +1412,4 @@ def update_cart (action, productId, customer):
 
     if orderItem.quantity <= 0:
         orderItem.delete()
-
-# Comment out this line before running a migration
-# Uncomment it after the migration and before you run the server
-check_auction_time()
+    invalidate_cart_summary(customer)